@@ -0,0 +1,69 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Admin Routes for cron jobs, startup information and instance
+#              stats
+#
+# Sources: App Engine cron requests
+#          https://cloud.google.com/appengine/docs/standard/python3/scheduling-jobs-with-cron-yaml
+from flask import abort, request, Blueprint, current_app
+import json
+import datetime as dt
+import constants as c
+import datastoreHelpers as ds
+import cacheHelpers as cache
+import authHelpers as auth
+import httpHelpers as http
+import rateLimitHelpers as limits
+import oauth
+
+bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+def verify_cron():
+    # App Engine removes this header from requests that are not from cron
+    if request.headers.get("X-Appengine-Cron") != "true":
+        abort(403, description=c.admin_errors["not_cron"])
+
+
+def verify_admin():
+    # Cron or a user listed in admin_users
+    if request.headers.get("X-Appengine-Cron") != "true" and \
+            not oauth.is_admin(request.headers.get("Authorization")):
+        abort(403, description=c.admin_errors["not_admin"])
+
+
+@bp.route('/counters', methods=['GET'])
+def counters_get():
+    verify_cron()
+    results = {}
+    for entity_kind in c.counted_kinds:
+        results[entity_kind] = ds.reconcile_counter(entity_kind)
+    return json.dumps({"reconciled": results}), 200
+
+
+@bp.route('/states', methods=['GET'])
+def states_get():
+    verify_cron()
+    # Expired oauth states and ones saved before states had an expiry
+    deleted = ds.delete_expired("oauth", "expires",
+                                dt.datetime.now(dt.timezone.utc))
+    return json.dumps({"deleted": deleted}), 200
+
+
+@bp.route('/startup', methods=['GET'])
+def startup_get():
+    verify_admin()
+    return json.dumps(current_app.config["STARTUP_REPORT"]), 200
+
+
+@bp.route('/stats', methods=['GET'])
+def stats_get():
+    verify_admin()
+    # Stats are kept per instance, so they are also logged for each call
+    stats = {"entity_cache": cache.get_cache_stats(),
+             "token_cache": auth.get_token_cache_stats(),
+             "http_latency": http.get_latency_histograms(),
+             "rate_limit": limits.get_rate_limit_stats()}
+    print(json.dumps(dict({"severity": "INFO", "message": "instance stats"},
+                          **stats)))
+    return json.dumps(stats), 200
@@ -0,0 +1,16 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Optional ASGI entrypoint that serves the same routes as main.py
+#              so concurrent requests overlap their Datastore and OAuth I/O
+#
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port $PORT --lifespan off
+#
+# google-cloud-datastore has no asyncio client, so each request runs the
+# Flask handlers on uvicorn's WSGI thread pool, bounded by async_workers.
+# The event loop keeps accepting connections while handlers wait on
+# Datastore or Google APIs.
+from uvicorn.middleware.wsgi import WSGIMiddleware
+import constants as c
+import main
+
+app = WSGIMiddleware(main.app, workers=c.async_workers)
@@ -0,0 +1,129 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Helper functions to verify Google ID tokens with cached signing
+#              certificates and a bounded cache of verified tokens
+#
+# Sources: google-auth id_token.verify_oauth2_token
+#          https://googleapis.dev/python/google-auth/latest/reference/google.oauth2.id_token.html
+from google.auth import jwt, exceptions
+import requests
+import threading
+import time
+import re
+from collections import OrderedDict
+import constants as c
+import httpHelpers as http
+
+_lock = threading.Lock()
+_certs = {"certs": None, "expires": 0}
+_verified_tokens = OrderedDict()
+_token_stats = {"hits": 0, "misses": 0}
+
+
+def get_certs():
+    """
+    Gets Google's public signing certificates, fetching them with the shared
+    HTTP session only when the cached copy has passed the max-age sent in
+    its Cache-Control header
+
+    :returns: certs (dict) mapping of key id to x509 certificate
+    """
+    now = time.time()
+    with _lock:
+        if _certs["certs"] and now < _certs["expires"]:
+            return _certs["certs"]
+
+    try:
+        res = http.get(c.google_certs_url)
+    except requests.RequestException as e:
+        raise exceptions.TransportError(e)
+    if res.status_code != 200:
+        raise exceptions.TransportError("Could not fetch certificates at "
+                                        + c.google_certs_url)
+    certs = res.json()
+    with _lock:
+        _certs["certs"] = certs
+        _certs["expires"] = now + get_max_age(res.headers)
+    return certs
+
+
+def get_max_age(headers):
+    """
+    Reads max-age from a Cache-Control header
+
+    :params:
+            headers (dict) response headers
+
+    :returns: (int) seconds the response may be cached
+    """
+    cache_control = headers.get("Cache-Control", "")
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if not match:
+        return c.google_certs_default_max_age
+    return int(match.group(1))
+
+
+def verify_token(token, audience):
+    """
+    Verifies a Google ID token and returns its sub. Tokens that were already
+    verified are served from a bounded LRU cache until their exp.
+
+    :params:
+            token (string) encoded ID token without the Bearer prefix
+            audience (string) OAuth client id the token must be issued for
+
+    :returns: user_id (string) sub claim of the token
+    Raises:
+        ValueError: If token verification fails
+        exceptions.GoogleAuthError: If the issuer is invalid
+    """
+    now = time.time()
+    with _lock:
+        cached = _verified_tokens.get(token)
+        if cached and now < cached["exp"]:
+            _verified_tokens.move_to_end(token)
+            _token_stats["hits"] += 1
+            return cached["sub"]
+        elif cached:
+            del _verified_tokens[token]
+        _token_stats["misses"] += 1
+
+    id_info = verify_oauth2_token(token, audience)
+    with _lock:
+        _verified_tokens[token] = {"sub": id_info["sub"],
+                                   "exp": id_info["exp"]}
+        _verified_tokens.move_to_end(token)
+        while len(_verified_tokens) > c.token_cache_size:
+            _verified_tokens.popitem(last=False)
+    return id_info["sub"]
+
+
+def verify_oauth2_token(token, audience):
+    """
+    Same checks as google.oauth2.id_token.verify_oauth2_token but uses the
+    cached certificates instead of downloading them for every token
+
+    :params:
+            token (string) encoded ID token
+            audience (string) OAuth client id the token must be issued for
+
+    :returns: id_info (dict) decoded token claims
+    """
+    id_info = jwt.decode(token, certs=get_certs(), audience=audience)
+    if id_info["iss"] not in c.google_issuers:
+        raise exceptions.GoogleAuthError(
+            "Wrong issuer. 'iss' should be one of the following: {}".format(
+                c.google_issuers))
+    return id_info
+
+
+def get_token_cache_stats():
+    """
+    Gets hit and miss counts for the verified token cache
+
+    :returns: (dict) hits, misses and current size of the cache
+    """
+    with _lock:
+        return {"hits": _token_stats["hits"],
+                "misses": _token_stats["misses"],
+                "size": len(_verified_tokens)}
@@ -0,0 +1,301 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Load test benchmark that runs the Flask app against the
+#              in-memory Datastore stand-in (or the Datastore emulator) with
+#              JWT verification stubbed and reports latency percentiles, throughput and RPCs per
+#              request for a set of realistic request mixes
+#
+# Run from the repository root:
+#     python benchmarks/benchmark.py
+#     python benchmarks/benchmark.py --latency 0.005 --threads 8 --json
+#     DATASTORE_EMULATOR_HOST=localhost:8081 DATASTORE_PROJECT_ID=marina \
+#         python benchmarks/benchmark.py --emulator
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import credentials
+except ImportError:
+    # The real credentials are not needed because JWTs are stubbed
+    credentials = types.ModuleType("credentials")
+    credentials.credentials = {"client_id": "benchmark",
+                               "client_secret": "benchmark",
+                               "redirect_uris": ["", ""]}
+    sys.modules["credentials"] = credentials
+
+import fakeDatastore
+import authHelpers as auth
+import constants
+import datastoreHelpers as ds
+
+emulator = "--emulator" in sys.argv[1:]
+fake = fakeDatastore.FakeClient()
+if not emulator:
+    ds.client._client = fake
+# Each scenario is one user sending many requests, so lift the rate limit
+constants.rate_limit_per_second = 1e9
+# The JWT is the user id, so any Bearer value is a valid user
+auth.verify_oauth2_token = lambda token, audience: {
+    "sub": token, "exp": time.time() + 3600, "iss": "accounts.google.com"}
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main
+
+client = main.app.test_client()
+
+
+def get_headers(user):
+    return {"Authorization": "Bearer " + user, "Accept": "application/json"}
+
+
+def send(method, url, user, body=None):
+    """
+    Sends a request to the app
+
+    :returns: (tuple) status code and parsed JSON body or None
+    """
+    response = client.open(url, method=method, headers=get_headers(user),
+                           json=body)
+    try:
+        content = json.loads(response.data) if response.data else None
+    except ValueError:
+        content = None
+    return response.status_code, content
+
+
+def expect(status, expected, what):
+    """
+    Fails the run when a request did not answer as expected, so a broken
+    endpoint is not reported as a fast one
+
+    :params:
+            status (int) status code that was answered
+            expected (int) status code the scenario needs
+            what (string) request or item that answered
+
+    :returns: None
+    """
+    if status != expected:
+        raise AssertionError("{} answered {}, expected {}".format(
+            what, status, expected))
+    return None
+
+
+def create_boat(user):
+    boat = {"name": "Boat", "type": "Tanker", "length": 100}
+    status, content = send("POST", "/boats", user, boat)
+    expect(status, 201, "POST /boats")
+    return content["id"]
+
+
+def create_loads(user, count):
+    loads = [{"volume": i, "item": "Pallet " + str(i),
+              "creation_date": "10/18/2026"} for i in range(count)]
+    status, content = send("POST", "/loads:batch", user, loads)
+    expect(status, 200, "POST /loads:batch")
+    for result in content["loads"]:
+        expect(result["status"], 201, "loads:batch item")
+    return [result["id"] for result in content["loads"]]
+
+
+def setup_paged_boats(user, args):
+    for i in range(args.boats):
+        create_boat(user)
+    return None
+
+
+def run_paged_boats(user, state):
+    # Page through every boat the user owns
+    url = "/boats?limit=5"
+    requests = 0
+    while url:
+        status, content = send("GET", url, user)
+        expect(status, 200, "GET /boats")
+        requests += 1
+        url = content["next"]
+        if url:
+            url = url[url.index("/boats"):]
+    return requests
+
+
+def setup_assign_loads(user, args):
+    return {"boat": create_boat(user),
+            "loads": iter(create_loads(user, args.iterations))}
+
+
+def run_assign_loads(user, state):
+    load_id = next(state["loads"])
+    status, content = send(
+        "PUT", "/boats/{}/loads/{}".format(state["boat"], load_id), user)
+    expect(status, 204, "PUT /boats/<id>/loads/<id>")
+    return 1
+
+
+def setup_delete_boats(user, args):
+    return {"loads_per_boat": args.loads_per_boat}
+
+
+def run_delete_boats(user, state):
+    # Make a boat full of loads and delete it, all four requests are timed
+    boat_id = create_boat(user)
+    load_ids = create_loads(user, state["loads_per_boat"])
+    status, content = send("PUT", "/boats/{}/loads".format(boat_id), user,
+                           load_ids)
+    expect(status, 200, "PUT /boats/<id>/loads")
+    for result in content["loads"]:
+        expect(result["status"], 204, "PUT /boats/<id>/loads item")
+    status, content = send("DELETE", "/boats/{}".format(boat_id), user)
+    expect(status, 204, "DELETE /boats/<id>")
+    return 4
+
+
+def setup_bulk_create(user, args):
+    return {"batch_size": args.batch_size}
+
+
+def run_bulk_create(user, state):
+    create_loads(user, state["batch_size"])
+    return 1
+
+
+scenarios = {
+    "paged_boats": (setup_paged_boats, run_paged_boats),
+    "assign_loads": (setup_assign_loads, run_assign_loads),
+    "delete_boats": (setup_delete_boats, run_delete_boats),
+    "bulk_create": (setup_bulk_create, run_bulk_create),
+}
+
+
+def get_percentile(values, percent):
+    """
+    Gets the nearest-rank percentile of a list of numbers
+
+    :params:
+            values (list) numbers
+            percent (int) percentile from 0 to 100
+
+    :returns: (float) percentile value
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_scenario(name, args):
+    """
+    Runs one scenario for args.iterations iterations on args.threads
+    threads and summarizes the results
+
+    :returns: (dict) latency percentiles in ms, throughput and RPCs
+    """
+    setup, run = scenarios[name]
+    user = "benchmark-" + name
+    with contextlib.redirect_stdout(io.StringIO()):
+        state = setup(user, args)
+    fake.latency = args.latency
+    logs = io.StringIO()
+
+    def timed_run(i):
+        start = time.perf_counter()
+        requests = run(user, state)
+        return (time.perf_counter() - start) * 1000, requests
+
+    rpcs_before = fake.get_rpc_count()
+    start = time.perf_counter()
+    # The app prints a profile log line per request, kept to count RPCs
+    with contextlib.redirect_stdout(logs), \
+            ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(timed_run, range(args.iterations)))
+    elapsed = time.perf_counter() - start
+    fake.latency = 0.0
+
+    latencies = [ms for ms, requests in results]
+    requests = sum(requests for ms, requests in results)
+    if emulator:
+        rpcs = get_logged_rpcs(logs.getvalue())
+    else:
+        rpcs = fake.get_rpc_count() - rpcs_before
+    return {"scenario": name,
+            "iterations": args.iterations,
+            "requests": requests,
+            "p50_ms": round(get_percentile(latencies, 50), 2),
+            "p95_ms": round(get_percentile(latencies, 95), 2),
+            "p99_ms": round(get_percentile(latencies, 99), 2),
+            "requests_per_s": round(requests / elapsed, 1),
+            "rpcs_per_request": round(rpcs / requests, 2)}
+
+
+def get_logged_rpcs(logs):
+    """
+    Adds up the datastore_rpcs of each request profile log line. Used with
+    the emulator, where the fake's RPC counts are not available.
+
+    :params:
+            logs (string) captured stdout of the app
+
+    :returns: (int) Datastore RPCs made by the logged requests
+    """
+    rpcs = 0
+    for line in logs.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict):
+            rpcs += entry.get("datastore_rpcs", 0)
+    return rpcs
+
+
+def print_table(results):
+    columns = ["scenario", "iterations", "requests", "p50_ms", "p95_ms",
+               "p99_ms", "requests_per_s", "rpcs_per_request"]
+    print("  ".join("{:>16}".format(column) for column in columns))
+    for result in results:
+        print("  ".join("{:>16}".format(result[column])
+                        for column in columns))
+
+
+def main_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenario", action="append",
+                        choices=sorted(scenarios),
+                        help="scenario to run, can be repeated "
+                             "(default: all)")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every fake Datastore RPC")
+    parser.add_argument("--boats", type=int, default=50,
+                        help="boats owned by the paged_boats user")
+    parser.add_argument("--loads-per-boat", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--emulator", action="store_true",
+                        help="use the Datastore emulator set by "
+                             "DATASTORE_EMULATOR_HOST instead of the fake")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON lines")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = main_args()
+    results = [run_scenario(name, args)
+               for name in args.scenario or list(scenarios)]
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
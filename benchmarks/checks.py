@@ -0,0 +1,197 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Behaviour checks that run the Flask app against the in-memory
+#              Datastore stand-in used by the benchmarks. They cover keyset
+#              pagination, ETags and the carrier / load_ids invariant, and
+#              exit with an error on the first check that fails.
+#
+# Run from the repository root:
+#     python benchmarks/checks.py
+import contextlib
+import io
+
+import benchmark
+from benchmark import send, expect, create_boat, create_loads, fake
+
+user = "checks"
+
+
+def check(condition, message):
+    """
+    Fails the run when a condition does not hold
+
+    :params:
+            condition (bool) what has to be true
+            message (string) what went wrong
+
+    :returns: None
+    """
+    if not condition:
+        raise AssertionError(message)
+    return None
+
+
+def get_path(url):
+    # Links are absolute, the test client needs the path and query
+    return url[url.index("/", len("http://")):] if url else None
+
+
+def get_headers(**headers):
+    headers.update(benchmark.get_headers(user))
+    return headers
+
+
+def check_carriers():
+    """
+    Checks that every load's carrier lists the load in its load_ids and
+    that every load in a boat's load_ids has that boat as its carrier
+
+    :returns: None
+    """
+    loads = {key[1]: e for key, e in fake.store.items()
+             if key[0] == benchmark.constants.loads}
+    boats = {key[1]: e for key, e in fake.store.items()
+             if key[0] == benchmark.constants.boats}
+    for load_id, load in loads.items():
+        if load["carrier"]:
+            check(load["carrier"] in boats,
+                  "load {} is on deleted boat {}".format(load_id,
+                                                         load["carrier"]))
+            check(load_id in boats[load["carrier"]]["load_ids"],
+                  "load {} is missing from boat {} load_ids".format(
+                      load_id, load["carrier"]))
+    for boat_id, boat in boats.items():
+        for load_id in boat["load_ids"]:
+            check(load_id in loads and loads[load_id]["carrier"] == boat_id,
+                  "boat {} lists load {} that is not on it".format(
+                      boat_id, load_id))
+    return None
+
+
+def check_pagination():
+    # Tied sort values must each be returned once, in both directions
+    load_ids = create_loads(user, 12)
+    for i in range(0, len(load_ids), 4):
+        status, content = send("PATCH", "/loads/{}".format(load_ids[i]),
+                               user, {"volume": 1})
+        expect(status, 200, "PATCH /loads/<id>")
+    volumes = {}
+    for load_id in load_ids:
+        status, content = send("GET", "/loads/{}".format(load_id), user)
+        volumes[load_id] = content["volume"]
+    ordered = sorted(load_ids, key=lambda id: (volumes[id], id))
+
+    url = "/loads?sort=volume&limit=5"
+    pages = []
+    while url:
+        status, content = send("GET", url, user)
+        expect(status, 200, "GET " + url)
+        pages.append(content)
+        url = get_path(content["next"])
+    forward = [e["id"] for page in pages for e in page["loads"]]
+    check(forward == ordered, "sorted pages returned {}, expected {}".format(
+        forward, ordered))
+
+    backward = []
+    url = get_path(pages[-1]["prev"])
+    while url:
+        status, content = send("GET", url, user)
+        expect(status, 200, "GET " + url)
+        backward = [e["id"] for e in content["loads"]] + backward
+        url = get_path(content["prev"])
+    check(backward == ordered[:len(backward)] and
+          len(backward) == len(ordered) - len(pages[-1]["loads"]),
+          "prev pages returned {}".format(backward))
+
+    # Repeated range filters are kept in the next link
+    url = "/loads?volume=gt:2&volume=lt:8&sort=volume&limit=2"
+    found = []
+    while url:
+        status, content = send("GET", url, user)
+        expect(status, 200, "GET " + url)
+        found.extend(e["volume"] for e in content["loads"])
+        url = get_path(content["next"])
+    check(found and all(2 < volume < 8 for volume in found),
+          "range filter pages returned volumes {}".format(found))
+    return None
+
+
+def check_etags():
+    boat_id = create_boat(user)
+    load_id = create_loads(user, 1)[0]
+    url = "/boats/{}".format(boat_id)
+    response = benchmark.client.get(url, headers=get_headers())
+    etag = response.headers.get("ETag")
+    check(etag, "GET /boats/<id> has no ETag")
+
+    response = benchmark.client.get(url, headers=get_headers(
+        **{"If-None-Match": etag}))
+    expect(response.status_code, 304, "GET /boats/<id> with its ETag")
+
+    status, content = send("PUT", "/boats/{}/loads/{}".format(boat_id,
+                                                              load_id), user)
+    expect(status, 204, "PUT /boats/<id>/loads/<id>")
+    response = benchmark.client.get(url, headers=get_headers(
+        **{"If-None-Match": etag}))
+    expect(response.status_code, 200, "GET /boats/<id> after a load was added")
+    loaded_etag = response.headers.get("ETag")
+
+    # Editing a load on the boat changes the boat's manifest
+    status, content = send("PATCH", "/loads/{}".format(load_id), user,
+                           {"item": "Crate"})
+    expect(status, 200, "PATCH /loads/<id>")
+    response = benchmark.client.get(url, headers=get_headers(
+        **{"If-None-Match": loaded_etag}))
+    expect(response.status_code, 200, "GET /boats/<id> after its load changed")
+
+    response = benchmark.client.patch(url, json={"name": "Renamed"},
+                                      headers=get_headers(
+                                          **{"If-Match": etag}))
+    expect(response.status_code, 412, "PATCH /boats/<id> with a stale ETag")
+    return None
+
+
+def check_carrier_invariant():
+    boat_ids = [create_boat(user) for i in range(3)]
+    load_ids = create_loads(user, 9)
+    status, content = send("PUT", "/boats/{}/loads".format(boat_ids[0]),
+                           user, load_ids[:4])
+    expect(status, 200, "PUT /boats/<id>/loads")
+    for load_id in load_ids[4:7]:
+        status, content = send(
+            "PUT", "/boats/{}/loads/{}".format(boat_ids[1], load_id), user)
+        expect(status, 204, "PUT /boats/<id>/loads/<id>")
+    status, content = send(
+        "PUT", "/boats/{}/loads/{}".format(boat_ids[2], load_ids[0]), user)
+    expect(status, 403, "PUT a load that is on another boat")
+    check_carriers()
+
+    status, content = send(
+        "DELETE", "/boats/{}/loads/{}".format(boat_ids[1], load_ids[4]), user)
+    expect(status, 204, "DELETE /boats/<id>/loads/<id>")
+    status, content = send("DELETE", "/loads/{}".format(load_ids[5]), user)
+    expect(status, 204, "DELETE /loads/<id>")
+    status, content = send("POST", "/loads:batch", user, [
+        {"id": load_ids[6], "volume": 3, "item": "Crate",
+         "creation_date": "10/18/2026"}])
+    expect(content["loads"][0]["status"], 200, "loads:batch update")
+    check_carriers()
+
+    status, content = send("DELETE", "/boats/{}".format(boat_ids[0]), user)
+    expect(status, 204, "DELETE /boats/<id>")
+    status, content = send(
+        "PUT", "/boats/{}/loads/{}".format(boat_ids[2], load_ids[0]), user)
+    expect(status, 204, "PUT a load from a deleted boat")
+    check_carriers()
+    return None
+
+
+checks = [check_pagination, check_etags, check_carrier_invariant]
+
+
+if __name__ == "__main__":
+    for run_check in checks:
+        # The app prints a profile log line per request
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_check()
+        print("ok", run_check.__name__)
@@ -0,0 +1,318 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: In-memory stand-in for google.cloud.datastore.Client used by
+#              the benchmarks. It keeps entities in a dict, counts RPCs the
+#              way Datastore would bill them and can add a fixed latency to
+#              each RPC so network bound code paths show up in timings.
+#
+# Writes inside a transaction or batch are applied right away and the
+# commit is counted when the block exits. Transactions never conflict.
+from google.cloud import datastore
+from google.cloud.datastore.query import And, Or, PropertyFilter
+import base64
+import copy
+import itertools
+import threading
+import time
+
+
+class FakeIterator:
+    """
+    Result of FakeQuery.fetch with the pages and next_page_token attributes
+    the real iterator has
+    """
+
+    def __init__(self, client, query, limit, start, after):
+        self.client = client
+        self.query = query
+        self.limit = limit
+        self.start = start
+        self.after = after
+        self.next_page_token = None
+        self.pages = iter([self._page()])
+
+    def _page(self):
+        results = self.query.run()
+        if self.after is not None:
+            # Like a real cursor, start after the position of the last
+            # entity even if it was deleted or changed since
+            results = [e for e in results if e.key != self.after.key]
+            results = self.query.sort(results + [self.after])
+            position = next(i for i, e in enumerate(results)
+                            if e is self.after)
+            results = results[position + 1:]
+        end = len(results) if self.limit is None else self.start + self.limit
+        page = results[self.start:end]
+        if end < len(results) and page:
+            self.next_page_token = self.client.save_cursor(page[-1])
+        return [self.query.shape(e) for e in page]
+
+    def __iter__(self):
+        for page in self.pages:
+            for e in page:
+                yield e
+
+
+class FakeQuery:
+    """
+    Query over one kind supporting add_filter, order, projection and
+    keys_only
+    """
+
+    def __init__(self, client, kind, projection=(), order=()):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+        self.order = list(order)
+        self.projection = list(projection)
+        self.is_keys_only = False
+
+    def add_filter(self, property_name=None, operator=None, value=None,
+                   filter=None):
+        if filter is None:
+            filter = PropertyFilter(property_name, operator, value)
+        self.filters.append(filter)
+        return self
+
+    def keys_only(self):
+        self.projection = ["__key__"]
+        self.is_keys_only = True
+
+    def get_value(self, e, property_name):
+        if property_name == "__key__":
+            return e.key.id_or_name
+        return e.get(property_name)
+
+    def matches(self, e, filters=None):
+        return all(self.matches_filter(e, f)
+                   for f in (self.filters if filters is None else filters))
+
+    def matches_filter(self, e, f):
+        if isinstance(f, Or):
+            return any(self.matches_filter(e, sub) for sub in f.filters)
+        if isinstance(f, And):
+            return self.matches(e, f.filters)
+        property_name, operator, value = \
+            f.property_name, f.operator, f.value
+        if property_name not in e and property_name != "__key__":
+            return False
+        v = self.get_value(e, property_name)
+        if isinstance(value, datastore.Key):
+            value = value.id_or_name
+        if operator in ("=", "=="):
+            return v == value
+        if operator == "IN":
+            return v in value
+        if operator == "NOT_IN":
+            return v not in value
+        if operator == "!=":
+            return v != value
+        if v is None or value is None or \
+                sort_key(v)[0] != sort_key(value)[0]:
+            return False
+        if operator == ">":
+            return v > value
+        if operator == ">=":
+            return v >= value
+        if operator == "<":
+            return v < value
+        if operator == "<=":
+            return v <= value
+        return True
+
+    def run(self):
+        with self.client.lock:
+            results = [e for (kind, _), e in self.client.store.items()
+                       if kind == self.kind and self.matches(e)]
+        return self.sort(results)
+
+    def sort(self, results):
+        order = list(self.order)
+        if not any(o.lstrip("-") == "__key__" for o in order):
+            order.append("__key__")
+        for o in reversed(order):
+            property_name = o.lstrip("-")
+            results.sort(key=lambda e: sort_key(
+                self.get_value(e, property_name)), reverse=o.startswith("-"))
+        return results
+
+    def shape(self, e):
+        if self.is_keys_only:
+            return datastore.Entity(key=e.key)
+        if self.projection:
+            projected = datastore.Entity(key=e.key)
+            for property_name in self.projection:
+                if property_name in e:
+                    projected[property_name] = e[property_name]
+            return projected
+        return copy.deepcopy(e)
+
+    def fetch(self, limit=None, start_cursor=None, offset=0, **kwargs):
+        self.client.rpc("query")
+        after = self.client.cursors.get(start_cursor) if start_cursor \
+            else None
+        return FakeIterator(self.client, self, limit, offset, after)
+
+
+def sort_key(value):
+    # Datastore orders None before numbers before strings
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+class FakeAggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeAggregationQuery:
+    def __init__(self, client, query):
+        self.client = client
+        self.query = query
+        self.alias = None
+
+    def count(self, alias=None):
+        self.alias = alias
+        return self
+
+    def fetch(self, **kwargs):
+        self.client.rpc("query")
+        total = len(self.query.run())
+        return iter([[FakeAggregationResult(self.alias, total)]])
+
+
+class FakeBatch:
+    """
+    Transaction or batch. Mutations are applied immediately and one commit
+    RPC is counted when the block exits without an error.
+    """
+
+    def __init__(self, client, transactional):
+        self.client = client
+        self.transactional = transactional
+
+    def __enter__(self):
+        if self.transactional:
+            self.client.rpc("begin")
+        self.client.local.depth = getattr(self.client.local, "depth", 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.local.depth -= 1
+        if exc_type is None:
+            self.client.rpc("commit")
+        return False
+
+    def put(self, entity):
+        self.client.store_entity(entity)
+
+    def delete(self, key):
+        self.client.remove(key)
+
+
+class FakeClient:
+    """
+    In-memory Datastore client with the methods datastoreHelpers uses
+    """
+
+    project = "benchmark"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.store = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.rpcs = {}
+        self.cursors = {}
+
+    def save_cursor(self, entity):
+        # The cursor is a token for a copy of the last entity of a page
+        with self.lock:
+            token = base64.b64encode(str(len(self.cursors)).encode())
+            self.cursors[token] = copy.deepcopy(entity)
+        return token
+
+    def rpc(self, operation):
+        with self.lock:
+            self.rpcs[operation] = self.rpcs.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def write_rpc(self, operation):
+        # Writes in a transaction or batch are sent with the commit
+        if not getattr(self.local, "depth", 0):
+            self.rpc(operation)
+
+    def get_rpc_count(self):
+        with self.lock:
+            return sum(self.rpcs.values())
+
+    def key(self, *path):
+        return datastore.Key(*path, project=self.project)
+
+    def complete_key(self, key):
+        if key.is_partial:
+            key = key.completed_key(next(self.ids))
+        return key
+
+    def store_entity(self, entity):
+        with self.lock:
+            entity.key = self.complete_key(entity.key)
+            self.store[(entity.key.kind, entity.key.id_or_name)] = \
+                copy.deepcopy(entity)
+
+    def remove(self, key):
+        with self.lock:
+            self.store.pop((key.kind, key.id_or_name), None)
+
+    def get(self, key, **kwargs):
+        self.rpc("get")
+        with self.lock:
+            e = self.store.get((key.kind, key.id_or_name))
+            return copy.deepcopy(e)
+
+    def get_multi(self, keys, **kwargs):
+        self.rpc("get")
+        with self.lock:
+            found = [self.store.get((k.kind, k.id_or_name)) for k in keys]
+            return [copy.deepcopy(e) for e in found if e is not None]
+
+    def put(self, entity):
+        self.write_rpc("put")
+        self.store_entity(entity)
+
+    def put_multi(self, entities):
+        self.write_rpc("put")
+        for e in entities:
+            self.store_entity(e)
+
+    def delete(self, key):
+        self.write_rpc("delete")
+        self.remove(key)
+
+    def delete_multi(self, keys):
+        self.write_rpc("delete")
+        for k in keys:
+            self.remove(k)
+
+    def query(self, kind=None, projection=(), order=(), **kwargs):
+        return FakeQuery(self, kind, projection, order)
+
+    def aggregation_query(self, query):
+        return FakeAggregationQuery(self, query)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        self.rpc("allocate_ids")
+        with self.lock:
+            return [self.complete_key(incomplete_key) for i in range(num_ids)]
+
+    def batch(self):
+        return FakeBatch(self, False)
+
+    def transaction(self, **kwargs):
+        return FakeBatch(self, True)
@@ -4,8 +4,8 @@
 #
 # Sources: OSU CS493 Module 4 Exploration
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
-from flask import abort, request, Blueprint
-import json
+from flask import abort, request, Blueprint, Response, stream_with_context
+import responseHelpers as r
 import constants as c
 import datastoreHelpers as ds
 from oauth import verify_jwt
@@ -31,41 +31,75 @@ def boats_get_post():
         content = request.get_json()   
         if len(content) != 3:
             abort(400, {"message": c.edit_errors["missing_attribute"]})
+        if m.has_hidden_property(content):
+            abort(403, description=c.edit_errors["hidden_property"])
 
         # Create Entity
         content["owner"] = user_id
-        new_boat = ds.create_entity(c.boats, content)
-        new_boat = ds.add_id_self(new_boat, request, c.boats)
-        query_list = [{"property": "carrier",
-                       "operator": "=",
-                       "value": int(new_boat["id"])}]
-        new_boat["loads"] = ds.get_add_filter_query(c.loads,
-                                                    query_list)
-        return new_boat, 201
+        content["load_ids"] = []
+        new_boat = ds.create_entity(c.boats, content,
+                                    exclude_from_indexes=("load_ids",))
+        # A boat that was just created can not have loads yet
+        return r.json_response(r.boat_record(new_boat, loads=[]), 201,
+                               m.get_etag_header(ds.get_etag(new_boat)))
         
     elif request.method == 'GET':
         # Return all boats owned by owner (JWT sub)
         query_list = [{"property": "owner", "operator": "=", "value": user_id}]
-        results = ds.get_filter_query(c.boats, query_list, request)
-        for e in results["boats"]:
-            e["loads"] = request.base_url + "/" + str(e["id"]) + "/" + \
-                         c.loads
-        return json.dumps(results), 200
+        page = m.get_page_options(request, c.boats, query_list)
+        fields = page["fields"]
+        embed = request.args.get("embed") == c.loads and \
+            (fields is None or "loads" in fields)
+        if embed and fields:
+            # load_ids is not indexed so embedded loads need full boats
+            page["fields"] = fields + ["load_ids"]
+        results = ds.get_filter_query(c.boats, page["filters"], request, page)
+        if embed:
+            # Get loads for the whole page in one lookup
+            loads = ds.get_boats_loads(results["boats"])
+            records = [r.boat_record(e, fields, [r.load_record(load)
+                                                 for load in loads[e.key.id]])
+                       for e in results["boats"]]
+        else:
+            records = [r.boat_record(e, fields) for e in results["boats"]]
+        return r.list_response(results, c.boats, records)
         
     else:
         abort(405)
 
 
-@bp.route('/<id>', methods=['GET', 'DELETE', 'PATCH', 'PUT'])
+@bp.route('/export', methods=['GET'])
+def boats_export():
+    # Validate correct accept type
+    if not request.accept_mimetypes.accept_json and \
+            not request.accept_mimetypes[c.ndjson]:
+        abort(406)
+
+    # Verify JWT
+    jwt = request.headers.get("Authorization")
+    user_id = verify_jwt(jwt)
+
+    def generate():
+        # Stream one boat owned by owner (JWT sub) per line
+        query_list = [{"property": "owner", "operator": "=", "value": user_id}]
+        for e in ds.iterate_query(c.boats, query_list):
+            yield r.dumps(r.boat_record(e)) + b"\n"
+
+    return Response(stream_with_context(generate()), 200, mimetype=c.ndjson)
+
+
+@bp.route('/<int:id>', methods=['GET', 'DELETE', 'PATCH', 'PUT'])
 def boat_get_delete_patch_put(id):
+    # Verify JWT, which also takes a rate limit token, before any read
+    jwt = request.headers.get("Authorization")
+    user_id = verify_jwt(jwt)
+
     # Verify boat exists
-    boat = ds.get_entity(c.boats, int(id))
+    boat = ds.get_entity(c.boats, id)
     if not boat:
         abort(404, {"message": c.boat_errors["invalid_boat_id"]})
-
-    # Verify JWT is valid
-    jwt = request.headers.get("Authorization")
-    user_id = verify_jwt(jwt)
+    # The boat's version changes with its loads so a match needs no loads
+    etag = ds.get_etag(boat)
 
     # Verify user is owner
     if boat["owner"] != user_id:
@@ -76,42 +110,35 @@ def boat_get_delete_patch_put(id):
         # Validate correct accept type
         if not request.accept_mimetypes.accept_json:
             abort(406)
+        if m.is_not_modified(request, etag):
+            return '', 304, m.get_etag_header(etag)
 
-        ds.add_id_self(boat, request, c.boats)
-        # boat["id"] = int(id)
-        # boat["self"] = ds.get_self_url(request, c.boats, int(id))
-        query_list = [{"property": "carrier",
-                       "operator": "=",
-                       "value": int(id)}]
-        boat["loads"] = ds.get_add_filter_query(c.loads, query_list)
-        for e in boat["loads"]:
-            e["self"] = ds.get_self_url(request, c.loads, e["id"])
-            ds.repackage_carrier(e, request)
-        return json.dumps(boat), 200
+        # Loads are only read after the owner is checked
+        loads = [r.load_record(e) for e in ds.get_boat_loads(boat)]
+        return r.json_response(r.boat_record(boat, loads=loads), 200,
+                               m.get_etag_header(etag))
             
     elif request.method == 'DELETE':
-        # If load is assigned to boat Remove from load Before Deleting
-        query_list = [{"property": "carrier",
-                       "operator": "=",
-                       "value": int(id)}]
-        results = ds.get_add_filter_query(c.loads, query_list)
-        ds.edit_property(results, "carrier", None)
-        ds.delete_entity(c.boats, int(id))
+        # Remove boat from its loads and delete it in one transaction
+        if not ds.delete_boat(id):
+            abort(404, {"message": c.boat_errors["invalid_boat_id"]})
         return '', 204
 
     elif request.method == 'PATCH':
-        edited_boat = m.run_patch(request, c.boats, id)
-        return edited_boat, 200
+        edited_boat, etag = m.run_patch(request, c.boats, id)
+        return r.json_response(r.boat_record(edited_boat), 200,
+                               m.get_etag_header(etag))
 
     elif request.method == 'PUT':
-        edited_boat = m.run_put(request, c.boats, id)
-        return edited_boat, 200
+        edited_boat, etag = m.run_put(request, c.boats, id)
+        return r.json_response(r.boat_record(edited_boat), 200,
+                               m.get_etag_header(etag))
 
     else:
         abort(405)
 
 
-@bp.route('/<boat_id>/loads/<load_id>', methods=['PUT', 'DELETE'])
+@bp.route('/<int:boat_id>/loads/<int:load_id>', methods=['PUT', 'DELETE'])
 def load_boat_put_delete(load_id, boat_id):
     # Validate correct accept type
     if not request.accept_mimetypes.accept_json:
@@ -121,9 +148,12 @@ def load_boat_put_delete(load_id, boat_id):
     jwt = request.headers.get("Authorization")
     user_id = verify_jwt(jwt)
 
+    # Read load and boat at the same time
+    load, boat = ds.run_parallel(
+        (ds.get_entity, c.loads, load_id),
+        (ds.get_entity, c.boats, boat_id))
+
     # Verify user is owner
-    load = ds.get_entity(c.loads, int(load_id))
-    boat = ds.get_entity(c.boats, int(boat_id))
     if not load or not boat:
         error_message = c.boat_errors["invalid_boat_id"] + " and/or " + \
                         c.load_errors["invalid_load_id"]
@@ -134,15 +164,16 @@ def load_boat_put_delete(load_id, boat_id):
         abort(403, description=c.oauth_errors["not_owner"])
     
     if request.method == 'PUT':
-        if load["carrier"] and load["carrier"] != int(boat_id):
+        if load["carrier"] and load["carrier"] != boat_id:
             abort(403, description=c.load_errors["already_loaded"])
-        else:
-            ds.edit_property([load], "carrier", int(boat_id))
+        elif ds.update_carrier(load_id, boat_id, True):
             return '', 204
+        else:
+            abort(403, description=c.load_errors["already_loaded"])
             
     elif request.method == 'DELETE':
-        if load["carrier"] == int(boat_id):
-            ds.edit_property([load], "carrier", None)
+        if load["carrier"] == boat_id and \
+                ds.update_carrier(load_id, boat_id, False):
             return '', 204
 
         else:
@@ -152,7 +183,51 @@ def load_boat_put_delete(load_id, boat_id):
         abort(405)
 
 
-@bp.route('/<id>/loads', methods=['GET'])
+@bp.route('/<int:id>/loads', methods=['PUT'])
+def boats_loads_put(id):
+    # Validate correct accept type
+    if not request.accept_mimetypes.accept_json:
+        abort(406)
+
+    # Verify JWT
+    jwt = request.headers.get("Authorization")
+    user_id = verify_jwt(jwt)
+
+    # Verify user is owner
+    boat = ds.get_entity(c.boats, id)
+    if not boat:
+        abort(404, {"message": c.boat_errors["invalid_boat_id"]})
+    if boat["owner"] != user_id:
+        # Sub doesn't match owner, Return 403
+        abort(403, description=c.oauth_errors["not_owner"])
+
+    # Validate list of load ids, the boat is also written in the transaction
+    load_ids = request.get_json(silent=True)
+    if not isinstance(load_ids, list) or \
+            len(load_ids) > c.max_mutations - 1 or \
+            not all(isinstance(load_id, int) for load_id in load_ids):
+        abort(400, {"message": c.batch_errors["invalid_load_ids"]})
+
+    # Assign all loads in one transaction and report each outcome
+    outcomes = ds.assign_loads(load_ids, id)
+    if outcomes is None:
+        abort(404, {"message": c.boat_errors["invalid_boat_id"]})
+    results = {"loads": []}
+    for load_id in load_ids:
+        if outcomes[load_id] == "assigned":
+            result = {"status": 204}
+        elif outcomes[load_id] == "missing":
+            result = {"status": 404,
+                      "Error": c.load_errors["invalid_load_id"]}
+        else:
+            result = {"status": 403,
+                      "Error": c.load_errors["already_loaded"]}
+        result["id"] = load_id
+        results["loads"].append(result)
+    return r.json_response(results)
+
+
+@bp.route('/<int:id>/loads', methods=['GET'])
 def boats_loads_get_(id):
     # Validate correct accept type
     if not request.accept_mimetypes.accept_json:
@@ -163,24 +238,25 @@ def boats_loads_get_(id):
     user_id = verify_jwt(jwt)
 
     # Verify user is owner
-    boat = ds.get_entity(c.boats, int(id))
+    boat = ds.get_entity(c.boats, id)
+    if not boat:
+        abort(404, {"message": c.boat_errors["invalid_boat_id"]})
     if boat["owner"] != user_id:
         # Sub doesn't match owner, Return 403
         abort(403, description=c.oauth_errors["not_owner"])
 
     if request.method == 'GET':
-        results = {"loads": []}
-
-        if not boat:
-            abort(404, {"message": c.boat_errors["invalid_boat_id"]})
-        query_list = [{"property": "carrier",
-                       "operator": "=",
-                       "value": int(id)}]
-        results["loads"] = ds.get_add_filter_query(c.loads, query_list)
-        for e in results["loads"]:
-            e["self"] = ds.get_self_url(request, c.loads, e["id"])
-            ds.repackage_carrier(e, request)
-        return json.dumps(results), 200
+        # Loads are read by key which can not be projected, so only the
+        # response is trimmed to the fields asked for
+        fields = m.get_fields(request, c.loads)
+        # The boat's version changes with its loads so a match needs no loads
+        etag = ds.get_etag(boat, c.loads, *(fields or []))
+        if m.is_not_modified(request, etag):
+            return '', 304, m.get_etag_header(etag)
+        records = [r.load_record(e, fields)
+                   for e in ds.get_boat_loads(boat)]
+        return r.list_response({}, c.loads, records,
+                               headers=m.get_etag_header(etag))
     else:
         abort(405)
 
@@ -0,0 +1,195 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Read-through cache for datastore entities keyed by kind and id
+#              and single-flight coalescing of identical concurrent reads
+#
+# The cache stores copies of entities so handlers can add id, self and other
+# response properties to the entity they get without changing the cache.
+# Any backend with get, set, delete and clear can be used with set_backend.
+import constants as c
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class CacheBackend:
+    """
+    Interface for cache backends. Values passed to set are already copies
+    and values returned by get are copied again before use.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    In-process LRU cache with a maximum size and per-entry expiry
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if time.time() >= entry["expires"]:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry["value"]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = {"value": value,
+                                 "expires": time.time() + ttl}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+backend = MemoryCache(c.entity_cache_size)
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+_in_flight = {}
+
+
+def set_backend(new_backend):
+    """
+    Replaces the cache backend, e.g. with a shared cache
+
+    :params:
+            new_backend (CacheBackend) backend to use
+
+    :returns: None
+    """
+    global backend
+    backend = new_backend
+    return None
+
+
+def lookup(entity_kind, entity_id):
+    """
+    Gets a copy of a cached entity
+
+    :params:
+            entity_kind (string) is the type of entity
+            entity_id (int or string) id or name of entity
+
+    :returns: entity (datastore entity) or None if it is not cached
+    """
+    entity = backend.get((entity_kind, entity_id))
+    with _stats_lock:
+        if entity is None:
+            _stats["misses"] += 1
+        else:
+            _stats["hits"] += 1
+    if entity is None:
+        return None
+    return copy.deepcopy(entity)
+
+
+def store(entity_kind, entity_id, entity):
+    """
+    Caches a copy of an entity for entity_cache_ttl seconds
+
+    :params:
+            entity_kind (string) is the type of entity
+            entity_id (int or string) id or name of entity
+            entity (datastore entity) entity to cache
+
+    :returns: None
+    """
+    backend.set((entity_kind, entity_id), copy.deepcopy(entity),
+                c.entity_cache_ttl)
+    return None
+
+
+def invalidate(keys):
+    """
+    Removes entities from the cache
+
+    :params:
+            keys (list) datastore keys of entities that changed
+
+    :returns: None
+    """
+    for key in keys:
+        backend.delete((key.kind, key.id_or_name))
+    return None
+
+
+def single_flight(key, func, *args):
+    """
+    Runs func once for concurrent callers with the same key. The first
+    caller runs it and the others wait for it and get copies of its result,
+    or its exception.
+
+    :params:
+            key (tuple) identifies the read, e.g. kind and id
+            func (function) read to run
+            args arguments to pass to func
+
+    :returns: return value of func
+    """
+    with _stats_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _in_flight[key] = future
+        else:
+            _stats["coalesced"] += 1
+    if not leader:
+        return copy.deepcopy(future.result())
+
+    try:
+        result = func(*args)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        with _stats_lock:
+            del _in_flight[key]
+    return result
+
+
+def get_cache_stats():
+    """
+    Gets hit and miss counts for the entity cache
+
+    :returns: (dict) hits, misses and hit rate of the cache and number of
+            reads that shared an in flight read
+    """
+    with _stats_lock:
+        total = _stats["hits"] + _stats["misses"]
+        hit_rate = _stats["hits"] / total if total else 0
+        return {"hits": _stats["hits"],
+                "misses": _stats["misses"],
+                "hit_rate": hit_rate,
+                "coalesced": _stats["coalesced"]}
@@ -1,15 +1,86 @@
-import string
 import credentials as cr
 
 boats = "boats"
 loads = "loads"
 users = "users"
 limit = 5
-allowed_chars = string.ascii_letters + string.digits
-state_size = 10
+max_limit = 100
+sort_properties = {
+    boats: ["name", "type", "length"],
+    loads: ["volume", "item", "creation_date"]
+}
+# Query parameters that filter listings. Equality properties take a value,
+# range properties take gt:, gte:, lt: or lte: and a number and must be
+# the sort property.
+filter_properties = {
+    boats: {"equal": ["type"], "range": ["length"]},
+    loads: {"equal": ["carrier"], "range": ["volume"]}
+}
+range_operators = {"gt:": ">", "gte:": ">=", "lt:": "<", "lte:": "<="}
+# Fields that can be picked with ?fields=. Key fields are built from the
+# entity key.
+response_fields = {
+    boats: ["id", "name", "type", "length", "owner", "loads", "self"],
+    loads: ["id", "volume", "item", "creation_date", "carrier", "self"]
+}
+key_fields = {
+    boats: ["id", "self", "loads"],
+    loads: ["id", "self"]
+}
+counted_kinds = [boats, loads]
+versioned_kinds = [boats, loads]
+# Stored properties that are never sent to clients
+hidden_properties = ["version", "load_ids"]
+stream_min_items = 200
+index_file = "index.yaml"
+stream_chunk_size = 100
+counter_kind = "counter_shard"
+counter_shards = 20
+count_cache_ttl = 5
+transaction_retries = 5
+in_filter_limit = 30
+max_mutations = 500
+max_lookup = 1000
+entity_cache_size = 2048
+entity_cache_ttl = 10
+export_batch_size = 500
+ndjson = "application/x-ndjson"
+max_batch_size = 1000
+async_workers = 32
+read_workers = 16
+error_cache_size = 256
+method_order = ["GET", "POST", "PUT", "PATCH", "DELETE"]
+datastore_operations = {
+    "get": "get",
+    "get_multi": "get",
+    "put": "put",
+    "put_multi": "put",
+    "delete": "delete",
+    "delete_multi": "delete",
+    "allocate_ids": "allocate"
+}
+admin_users = cr.credentials.get("admin_users", [])
+profile_lines = 30
+rate_limit_per_second = 10
+rate_limit_burst = 20
+rate_limit_users = 10000
+state_bytes = 32
+state_ttl = 600
 oauth_url = "https://accounts.google.com/o/oauth2/v2/auth"
 token_url = "https://oauth2.googleapis.com/token"
 names_url = "https://people.googleapis.com/v1/people/me?personFields=names"
+google_certs_url = "https://www.googleapis.com/oauth2/v1/certs"
+google_issuers = ["accounts.google.com", "https://accounts.google.com"]
+google_certs_default_max_age = 300
+http_connect_timeout = 3.05
+http_read_timeout = 10
+http_retries = 3
+http_backoff = 0.3
+http_retry_statuses = [500, 502, 503, 504]
+http_pool_connections = 4
+http_pool_size = 32
+http_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+token_cache_size = 1024
 oauth_params = {
     "response_type": "code",
     "client_id": cr.credentials["client_id"],
@@ -28,6 +99,12 @@ edit_errors = {
                                      " one of the required attributes",
                 "invalid_attribute_num": "Must have 1 or 2 attributes to PATCH"
                                          " the load with this load_id",
+                "hidden_property": "version and load_ids are set by the"
+                                   " server and can not be changed",
+                "etag_mismatch": "The resource has changed since the ETag in"
+                                 " If-Match was read",
+                "conflict": "The resource was changed by another request at"
+                            " the same time, try again",
 }
 
 boat_errors = {
@@ -43,6 +120,39 @@ load_errors = {
                 "already_loaded": "The load is already assigned to a boat"
 }
 
+batch_errors = {
+    "invalid_batch": "The request must be a JSON array or NDJSON of objects",
+    "batch_size": "A batch can have at most " + str(max_batch_size)
+                  + " items",
+    "invalid_load_ids": "The request must be a JSON array of at most "
+                        + str(max_mutations - 1) + " load ids",
+    "duplicate_id": "A load can only be updated once in a batch"
+}
+
+page_errors = {
+    "invalid_limit": "limit must be a whole number from 1 to "
+                     + str(max_limit),
+    "invalid_sort": "Can not sort by this property",
+    "invalid_cursor": "Invalid cursor",
+    "invalid_fields": "fields must be a comma separated list of properties"
+                      " of this resource",
+    "invalid_filter": "Invalid filter value",
+    "range_sort": "Range filters must be on one property and it must be the"
+                  " sort property",
+    "unsupported_query": "This combination of filters and sort is not"
+                         " supported"
+}
+
+rate_limit_errors = {
+    "too_many_requests": "Too many requests, retry after the number of "
+                         "seconds in Retry-After"
+}
+
+admin_errors = {
+    "not_cron": "Admin routes can only be called by App Engine cron",
+    "not_admin": "Only App Engine cron and admin users can view this"
+}
+
 oauth_errors = {
     "invalid_jwt": "Invalid JWT",
     "invalid_or_expired_jwt": "Invalid or Expired JWT. Update token.",
@@ -50,5 +160,6 @@ oauth_errors = {
     "invalid_state": "Unauthorized. State does not exist.",
     "accept_type": "Accept type must be application/json",
     "not_owner": "Protected resources can only be viewed by owner",
-    "state_error": "Invalid state. Authentication process aborted."
+    "state_error": "Invalid state. Authentication process aborted.",
+    "google_unavailable": "Could not reach Google. Try again later."
 }
@@ -5,13 +5,283 @@
 # Sources: OSU CS493 Module 4 Exploration
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
 from google.cloud import datastore
+from google.cloud.datastore.query import And, Or, PropertyFilter
+from google.api_core import exceptions
 import constants as c
-from urllib.parse import urlencode, unquote
+import cacheHelpers as cache
+import profileHelpers as profile
+from urllib.parse import urlencode
+import base64
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 
-client = datastore.Client()
 
 
-def create_entity(entity_kind, content, entity_id=None):
+class LazyClient:
+    """
+    Stands in for datastore.Client and creates it the first time it is used
+    so importing this module does not load credentials or open channels.
+    Lookup, write and id allocation calls are timed for request profiling.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        attribute = getattr(self._client, name)
+        if name in c.datastore_operations:
+            operation = "datastore-" + c.datastore_operations[name]
+            return profile.timed(operation)(attribute)
+        return attribute
+
+
+client = LazyClient()
+
+_count_lock = threading.Lock()
+_count_cache = {}
+read_executor = ThreadPoolExecutor(max_workers=c.read_workers,
+                                   thread_name_prefix="datastore-read")
+
+
+def submit(func, *args):
+    """
+    Starts a read on the shared read thread pool so it runs while the
+    caller does other work. Functions passed must not use the flask request.
+
+    :params:
+            func (function) function to run
+            args arguments to pass to func
+
+    :returns: (future) call result() to wait for and get the return value
+    """
+    # Copy the context so reads are recorded in the request's profile
+    context = contextvars.copy_context()
+    return read_executor.submit(context.run, func, *args)
+
+
+def run_parallel(*calls):
+    """
+    Runs independent reads at the same time and waits for all of them
+
+    :params:
+            calls (tuple) each call is a tuple of function and its arguments
+                        e.g. (get_entity, c.boats, 1)
+
+    :returns: (list) return value of each call in the same order. If a call
+            raised, the first exception in call order is raised.
+    """
+    futures = [submit(*call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def query_shape(entity_kind, equal=(), sort=None, paged=True):
+    """
+    Declares a query the app issues for the query catalog
+
+    :params:
+            entity_kind (string) is the type of entity
+            equal (list) properties in equality or IN filters
+            sort (string) sort property or None when sorted by key. Range
+                        filters are only allowed on the sort property.
+            paged (bool) the query is paged with get_page, which also runs it
+                        in reverse for prev links
+
+    :returns: (dict) query shape
+    """
+    return {"kind": entity_kind, "equal": sorted(equal), "sort": sort,
+            "paged": paged}
+
+
+# Every query get_page, get_query_count, iterate_query and
+# get_add_filter_query issues must match one of these. index.yaml is made
+# from this list by indexes.py.
+# Listings can add one equality filter from filter_properties to their
+# own filters and sort by any sort property except the filtered one.
+query_catalog = [
+    query_shape(entity_kind, base + equal, sort)
+    for entity_kind, base in ((c.boats, ["owner"]), (c.loads, []))
+    for equal in [[]] + [[name] for name in
+                         c.filter_properties[entity_kind]["equal"]]
+    for sort in [None] + c.sort_properties[entity_kind]
+    if sort not in equal
+] + [
+    # reconcile_counter counts every boat of every owner
+    query_shape(c.boats, paged=False),
+    # delete_expired finds states by expiry and scans their keys
+    query_shape("oauth", sort="expires", paged=False),
+    query_shape("oauth", paged=False),
+]
+
+
+def get_filter_properties(query_list):
+    """
+    Splits the properties of filters into equality and range filters
+
+    :params:
+            query_list (list) list of filters in get_add_filter_query format
+
+    :returns: (tuple) set of equality properties and set of range properties
+    """
+    equal = set()
+    ranges = set()
+    for q in query_list:
+        if q["operator"] in ("=", "IN"):
+            equal.add(q["property"])
+        else:
+            ranges.add(q["property"])
+    return equal, ranges
+
+
+def find_query_shape(entity_kind, query_list, sort=None, paged=False):
+    """
+    Finds the query catalog entry that matches a query
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+            sort (string) sort property or None when sorted by key
+            paged (bool) the query is paged with get_page
+
+    :returns: shape (dict) matching query shape or None
+    """
+    equal, ranges = get_filter_properties(query_list)
+    if ranges - {sort}:
+        return None
+    for shape in query_catalog:
+        if shape["kind"] == entity_kind and set(shape["equal"]) == equal \
+                and shape["sort"] == sort and (shape["paged"] or not paged):
+            return shape
+    return None
+
+
+def check_query(entity_kind, query_list, sort=None, paged=False):
+    """
+    Checks that a query is in the query catalog, so index.yaml has the
+    indexes it needs and it is not run as a full scan or rejected
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+            sort (string) sort property or None when sorted by key
+            paged (bool) the query is paged with get_page
+
+    :returns: shape (dict) matching query shape
+    Raises:
+        ValueError: If no query shape matches
+    """
+    shape = find_query_shape(entity_kind, query_list, sort, paged)
+    if shape is None:
+        equal, ranges = get_filter_properties(query_list)
+        raise ValueError("Query on {} with equality filters {}, range "
+                         "filters {} and sort {} is not in the query "
+                         "catalog".format(entity_kind, sorted(equal),
+                                          sorted(ranges), sort))
+    return shape
+
+
+def is_built_in(equal, properties):
+    """
+    Checks if Datastore's built-in indexes can serve a query without a
+    composite index. They serve queries with only equality filters
+    (ordered by key ascending) and queries on one property.
+
+    :params:
+            equal (list) properties in equality filters
+            properties (list) index properties as (name, direction) tuples
+
+    :returns: bool true if no composite index is needed otherwise false
+    """
+    if properties and properties[-1] == ("__key__", "asc"):
+        properties = properties[:-1]
+    if all(name in equal and direction == "asc"
+           for name, direction in properties):
+        return True
+    return len(properties) == 1 and properties[0][0] != "__key__"
+
+
+def get_shape_indexes(shape):
+    """
+    Gets the composite indexes a query shape needs. Paged queries are
+    ordered by the sort property and then key, in either direction.
+
+    :params:
+            shape (dict) query shape from query_shape
+
+    :returns: indexes (list) of index property lists of (name, direction)
+    """
+    sort_directions = ["asc", "desc"] if shape["sort"] else [None]
+    key_directions = ["asc", "desc"] if shape["paged"] else ["asc"]
+    indexes = []
+    for sort_direction in sort_directions:
+        for key_direction in key_directions:
+            properties = [(name, "asc") for name in shape["equal"]]
+            if shape["sort"]:
+                properties.append((shape["sort"], sort_direction))
+            properties.append(("__key__", key_direction))
+            if not is_built_in(shape["equal"], properties) and \
+                    properties not in indexes:
+                indexes.append(properties)
+    return indexes
+
+
+def get_index_yaml():
+    """
+    Makes index.yaml with the composite indexes every query in the query
+    catalog needs
+
+    :returns: (string) index.yaml content
+    """
+    lines = ["# Generated from the query catalog in datastoreHelpers.py by",
+             "# indexes.py. Do not edit, run python indexes.py instead.",
+             "indexes:"]
+    seen = []
+    for shape in query_catalog:
+        for properties in get_shape_indexes(shape):
+            if properties and properties[-1] == ("__key__", "asc"):
+                properties = properties[:-1]
+            if (shape["kind"], properties) in seen:
+                continue
+            seen.append((shape["kind"], properties))
+            lines.append("- kind: " + shape["kind"])
+            lines.append("  properties:")
+            for name, direction in properties:
+                lines.append("  - name: " + name)
+                lines.append("    direction: " + direction)
+    return "\n".join(lines) + "\n"
+
+
+def check_index_file(path=None):
+    """
+    Checks that index.yaml matches the query catalog
+
+    :params:
+            path (string) index.yaml path, defaults to the one next to this
+                        module
+
+    :returns: (bool) true if index.yaml is up to date otherwise false
+    """
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            c.index_file)
+    try:
+        with open(path) as index_file:
+            return index_file.read() == get_index_yaml()
+    except OSError:
+        return False
+
+
+def create_entity(entity_kind, content, entity_id=None,
+                  exclude_from_indexes=()):
     """
     Creates Datastore Entity from JSON Request
     
@@ -19,84 +289,341 @@ def create_entity(entity_kind, content, entity_id=None):
             entity_kind (string) is the type of entity
             content (dict) JSON request content
             entity_id int
+            exclude_from_indexes (tuple) properties that are not indexed
             
     :returns: new_entity (datastore entity) datastore entity that was created
     """
     if entity_id:
-        new_entity = datastore.Entity(key=client.key(entity_kind, entity_id))
+        new_entity = datastore.Entity(key=client.key(entity_kind, entity_id),
+                                      exclude_from_indexes=exclude_from_indexes)
     else:
-        new_entity = datastore.Entity(key=client.key(entity_kind))
+        new_entity = datastore.Entity(key=client.key(entity_kind),
+                                      exclude_from_indexes=exclude_from_indexes)
     new_entity.update(content)
+    bump_version(new_entity)
     client.put(new_entity)
-    if get_entity("counter", entity_kind):
+    cache.invalidate([new_entity.key])
+    if entity_kind in c.counted_kinds:
         increment_counter(entity_kind)
 
     return new_entity
 
 
-def get_all(entity_kind, request):
+def create_entities(entity_kind, content_list):
+    """
+    Creates many Datastore Entities with ids allocated in bulk, saves them
+    in batches and updates the counter once
+
+    :params:
+            entity_kind (string) is the type of entity
+            content_list (list) JSON request content for each entity
+
+    :returns: new_entities (list) datastore entities that were created
     """
-    Gets datastore entities of kind using cursor with limit set in constants
+    keys = []
+    for i in range(0, len(content_list), c.max_mutations):
+        num_ids = len(content_list[i:i + c.max_mutations])
+        keys.extend(client.allocate_ids(client.key(entity_kind), num_ids))
+    new_entities = []
+    for key, content in zip(keys, content_list):
+        new_entity = datastore.Entity(key=key)
+        new_entity.update(content)
+        new_entities.append(new_entity)
+    write_batch(new_entities)
+    if new_entities and entity_kind in c.counted_kinds:
+        update_counter(entity_kind, len(new_entities))
+
+    return new_entities
+
+
+def get_all(entity_kind, request, page=None):
+    """
+    Gets a page of datastore entities of kind
 
     Must use counter methods with this method
     
     :params: 
             entity_kind (string) is the type of entity
             request (flask request) flask request to pull url information from 
+            page (dict) page options from get_page_options, defaults to the
+                        first page sorted by key with the limit in constants
             
-    :returns: results (list) of datastore entities, a next link, and a count
+    :returns: results (list) of datastore entities, next and prev links,
+            and a count
     Source: https://canvas.oregonstate.edu/courses/1870359/modules/items/22099648
     """
-    query = client.query(kind=entity_kind)
-    q_cursor = unquote(request.args.get('cursor', ''))
-    result_iterator = query.fetch(limit=c.limit, start_cursor=q_cursor)
-    pages = result_iterator.pages
-    results = {"next": None,
-               "total_" + entity_kind: get_count(entity_kind),
-               entity_kind: list(next(pages))}
-    if result_iterator.next_page_token:
-        args = urlencode({"cursor": result_iterator.next_page_token})
-        results["next"] = request.base_url + "?" + args
-    else:
-        results["next"] = None
-    for e in results[entity_kind]:
-        add_id_self(e, request, entity_kind)
+    if include_total(request):
+        total = submit(get_count, entity_kind)
+    results = get_page(entity_kind, [], request, page)
+    if include_total(request):
+        results["total_" + entity_kind] = total.result()
     return results
 
 
-def get_filter_query(entity_kind, query_list, request):
+def get_filter_query(entity_kind, query_list, request, page=None):
     """
-    Gets datastore entities of kind with a particular filter and constant limit
+    Gets a page of datastore entities of kind with a particular filter
 
     :params:
             entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
             request (flask request) flask request to pull url information from
+            page (dict) page options from get_page_options, defaults to the
+                        first page sorted by key with the limit in constants
 
-    :returns: results (list) of datastore entities, a next link, and a count
+    :returns: results (list) of datastore entities, next and prev links,
+            and a count
     Source: https://canvas.oregonstate.edu/courses/1870359/modules/items/22099648
     """
+    if include_total(request):
+        total = submit(get_query_count, entity_kind, query_list)
+    results = get_page(entity_kind, query_list, request, page)
+    if include_total(request):
+        results["total_" + entity_kind] = total.result()
+    return results
+
+
+@profile.timed("datastore-query")
+def get_page(entity_kind, query_list, request, page=None):
+    """
+    Gets a page of entities using keyset pagination. Pages are ordered by
+    the sort property and then by key, and the cursor holds the sort value
+    and id of the last (or first, for prev) entity on the page so following
+    pages start right after it without an offset.
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+            request (flask request) flask request to pull url information from
+            page (dict) page options from get_page_options
+
+    :returns: results (dict) next link, prev link and the list of entities
+    """
+    if page is None:
+        page = {"limit": c.limit, "sort": None, "descending": False,
+                "cursor": None, "before": None, "fields": None}
+    backward = page["before"] is not None
+    position = page["before"] if backward else page["cursor"]
+    sort = page["sort"]
+    descending = page["descending"] != backward
+    shape = check_query(entity_kind, query_list, sort, paged=True)
+
     query = client.query(kind=entity_kind)
     for q in query_list:
         query.add_filter(q["property"], q["operator"], q["value"])
-    q_cursor = unquote(request.args.get('cursor', ''))
-    result_iterator = query.fetch(limit=c.limit, start_cursor=q_cursor)
+    projection = get_projection(shape, query_list, page.get("fields"))
+    if projection == []:
+        query.keys_only()
+    elif projection:
+        query.projection = projection
+    key_order = "-__key__" if backward else "__key__"
+    if sort:
+        query.order = [("-" if descending else "") + sort, key_order]
+    else:
+        query.order = [key_order]
+    if position:
+        after_key = PropertyFilter("__key__", "<" if backward else ">",
+                                   client.key(entity_kind, position[1]))
+        if sort:
+            # Entities tied on the sort value come after the cursor by key
+            query.add_filter(filter=Or([
+                And([PropertyFilter(sort, "=", position[0]), after_key]),
+                PropertyFilter(sort, "<" if descending else ">",
+                               position[0])]))
+        else:
+            query.add_filter(filter=after_key)
+
+    entities = list(query.fetch(limit=page["limit"] + 1))
+    if projection is not None:
+        for e in entities:
+            add_filter_values(e, query_list)
+    has_more = len(entities) > page["limit"]
+    entities = entities[:page["limit"]]
+    if backward:
+        entities.reverse()
+
+    results = {"next": None, "prev": None}
+    if entities and (has_more or backward):
+        results["next"] = get_page_url(request, "cursor", entities[-1], sort)
+    if entities and (position and not backward or has_more and backward):
+        results["prev"] = get_page_url(request, "before", entities[0], sort)
+    results[entity_kind] = entities
+    return results
+
+
+def get_projection(shape, query_list, fields):
+    """
+    Works out the smallest query that returns every field asked for. Fields
+    built from the key need no properties and properties in an equality
+    filter are already known. Only the sort property is projected, since it
+    is in the index the query already uses. Projecting other properties
+    needs an index that orders by them before the key, which breaks key
+    ordered pages.
+
+    :params:
+            shape (dict) query shape from check_query
+            query_list (list) list of filters in get_add_filter_query format
+            fields (list) fields from get_fields or None for every field
+
+    :returns: projection (list) properties to project, an empty list for a
+            keys-only query or None when full entities are needed
+    """
+    if fields is None:
+        return None
+    equal = {q["property"] for q in query_list if q["operator"] == "="}
+    sort = shape["sort"]
+    projection = [sort] if sort and sort not in equal else []
+    extra = [field for field in fields
+             if field not in c.key_fields[shape["kind"]] and
+             field not in equal and field not in projection]
+    if extra:
+        return None
+
+    return projection
+
+
+def add_filter_values(entity, query_list):
+    """
+    Sets properties that are in an equality filter on an entity from a
+    projection or keys-only query, which leaves them out
+
+    :params:
+            entity (datastore entity) entity from the query
+            query_list (list) list of filters in get_add_filter_query format
+
+    :returns: entity (datastore entity) entity that was passed
+    """
+    for q in query_list:
+        if q["operator"] == "=":
+            entity[q["property"]] = q["value"]
+
+    return entity
+
+
+def encode_cursor(entity, sort):
+    """
+    Makes a page cursor from the sort value and id of an entity
+
+    :params:
+            entity (datastore entity) entity the page starts after
+            sort (string) sort property or None when sorted by key
+
+    :returns: (string) url safe cursor
+    """
+    value = entity[sort] if sort else None
+    position = json.dumps([value, entity.key.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Reads a page cursor made by encode_cursor
+
+    :params:
+            cursor (string) url safe cursor
+
+    :returns: (list) sort value and id
+    Raises:
+        ValueError: If the cursor is not valid
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(position, list) or len(position) != 2:
+        raise ValueError("Invalid cursor")
+    value, id = position
+    if not isinstance(value, (type(None), bool, int, float, str)) or \
+            not isinstance(id, int) or isinstance(id, bool):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def get_page_url(request, direction, entity, sort):
+    """
+    Creates the url for the page before or after an entity keeping the
+    other query parameters of the request
+
+    :params:
+            request (flask request) flask request to pull url information from
+            direction (string) cursor for the next page, before for prev
+            entity (datastore entity) entity at the edge of the current page
+            sort (string) sort property or None when sorted by key
+
+    :returns: url (string) url of the page
+    """
+    # Range filters can be repeated, so every value of a parameter is kept
+    args = [(k, v) for k, v in request.args.items(multi=True)
+            if k not in ("cursor", "before")]
+    args.append((direction, encode_cursor(entity, sort)))
+    return request.base_url + "?" + urlencode(args)
+
+
+@profile.timed("datastore-query")
+def get_query_count(entity_kind, query_list):
+    """
+    Counts entities of kind that match filters with a Datastore count
+    aggregation so entities are counted on the server instead of fetched
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+
+    :returns: (int) number of matching entities
+    """
+    # A range filter is on the sort property of the page being counted
+    ranges = get_filter_properties(query_list)[1]
+    check_query(entity_kind, query_list, min(ranges, default=None))
     query = client.query(kind=entity_kind)
     for q in query_list:
         query.add_filter(q["property"], q["operator"], q["value"])
-    query.keys_only()
-    total = len(list(query.fetch()))
-    pages = result_iterator.pages
-    results = {"next": None,
-               "total_" + entity_kind: total,
-               entity_kind: list(next(pages))}
-    if result_iterator.next_page_token:
-        args = urlencode({"cursor": result_iterator.next_page_token})
-        results["next"] = request.base_url + "?" + args
-    else:
-        results["next"] = None
-    for e in results[entity_kind]:
-        add_id_self(e, request, entity_kind)
-    return results
+    aggregation = client.aggregation_query(query).count(alias="total")
+    for results in aggregation.fetch():
+        for result in results:
+            return result.value
+    return 0
+
+
+def include_total(request):
+    """
+    Checks if the client asked to leave the total out of a page with
+    ?include_total=false
+
+    :params:
+            request (flask request) flask request to pull url information from
+
+    :returns: bool false if include_total is false otherwise true
+    """
+    return request.args.get("include_total", "true").lower() != "false"
+
+
+def iterate_query(entity_kind, query_list):
+    """
+    Yields every entity of kind that matches the filters one batch at a time
+    using cursors so only one batch is held in memory
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+
+    :returns: generator of datastore entities
+    """
+    check_query(entity_kind, query_list)
+    q_cursor = None
+    while True:
+        query = client.query(kind=entity_kind)
+        for q in query_list:
+            query.add_filter(q["property"], q["operator"], q["value"])
+        start = time.perf_counter()
+        result_iterator = query.fetch(limit=c.export_batch_size,
+                                      start_cursor=q_cursor)
+        batch = list(next(result_iterator.pages))
+        profile.record("datastore-query", (time.perf_counter() - start) * 1000)
+        for e in batch:
+            yield e
+        q_cursor = result_iterator.next_page_token
+        if not q_cursor:
+            break
 
 
 def get_full_collection(entity_kind, request):
@@ -120,7 +647,8 @@ def get_full_collection(entity_kind, request):
 
 def get_entity(entity_kind, entity_id):
     """
-    Gets datastore entity with kind and id
+    Gets datastore entity with kind and id. Entities are read through the
+    entity cache and concurrent misses for the same entity share one read.
     
     :params: 
             entity_kind (string) is the type of entity
@@ -128,8 +656,29 @@ def get_entity(entity_kind, entity_id):
             
     :returns: entity (datastore entity) entity with key
     """
-    entity_key = client.key(entity_kind, entity_id)
-    entity = client.get(key=entity_key)
+    entity = cache.lookup(entity_kind, entity_id)
+    if entity is not None:
+        return entity
+
+    entity = cache.single_flight(("get", entity_kind, entity_id),
+                                 read_entity, entity_kind, entity_id)
+
+    return entity
+
+
+def read_entity(entity_kind, entity_id):
+    """
+    Reads an entity from Datastore and caches it
+
+    :params:
+            entity_kind (string) is the type of entity
+            entity_id (int) id of entity to retrieve
+
+    :returns: entity (datastore entity) entity or None if it does not exist
+    """
+    entity = client.get(key=client.key(entity_kind, entity_id))
+    if entity is not None:
+        cache.store(entity_kind, entity_id, entity)
 
     return entity
 
@@ -145,29 +694,74 @@ def get_entity_key(entity_kind, entity_id):
     return client.key(entity_kind, entity_id)
 
 
-def edit_entity(entity, content):
+def edit_entity(entity, content, if_match=None):
     """
-    Edits Datastore Entity from JSON Request
+    Edits Datastore Entity from JSON Request. The stored entity is edited in
+    a transaction so a stale cached copy can not undo other writes, and a
+    load's boat gets a new version since the load is part of its manifest.
     
     :params: 
             entity (datastore entity) entity to be edited
             content (dict) JSON request content
+            if_match (werkzeug ETags) If-Match of the request, the entity is
+                        only edited if its ETag is one of them
             
-    :returns: If entity doesn't exist returns None
+    :returns: If entity doesn't exist or does not match if_match returns None
             else returns:
             entity (datastore entity) datastore entity that was edited
     """
     
     if not entity:
         return
-        
-    for k, v in content.items():
-        entity[k] = v
-        
-    client.put(entity)
+
+    def edit(key):
+        entity = client.get(key)
+        if entity is None or if_match and get_etag(entity) not in if_match:
+            return None, []
+        for k, v in content.items():
+            entity[k] = v
+        put_list = [bump_version(entity)]
+        if entity.key.kind == c.loads and entity.get("carrier"):
+            boat = client.get(client.key(c.boats, entity["carrier"]))
+            if boat:
+                put_list.append(bump_version(boat))
+        client.put_multi(put_list)
+        return entity, put_list
+
+    entity, put_list = run_transaction(edit, entity.key)
+    cache.invalidate([e.key for e in put_list])
     return entity
 
 
+def edit_entities(entity_kind, edits):
+    """
+    Edits many entities of kind. Each group of max_mutations entities is
+    read, edited and saved in one transaction, so a write made after the
+    read is never overwritten.
+
+    :params:
+            entity_kind (string) is the type of entity
+            edits (dict) entity id to properties to set
+
+    :returns: edited (list) entities that were found and edited
+    """
+    ids = list(edits)
+
+    def edit(group):
+        keys = [client.key(entity_kind, id) for id in group]
+        entities = client.get_multi(keys)
+        for e in entities:
+            e.update(edits[e.key.id_or_name])
+        client.put_multi([bump_version(e) for e in entities])
+        return entities
+
+    edited = []
+    for i in range(0, len(ids), c.max_mutations):
+        edited.extend(run_transaction(edit, ids[i:i + c.max_mutations]))
+    cache.invalidate([e.key for e in edited])
+    return edited
+
+
 def delete_entity(entity_kind, entity_id):
     """
     Deletes datastore entity with kind and id
@@ -180,30 +774,62 @@ def delete_entity(entity_kind, entity_id):
     """
     entity_key = client.key(entity_kind, entity_id)
     client.delete(entity_key)
-    if get_entity("counter", entity_kind):
+    cache.invalidate([entity_key])
+    if entity_kind in c.counted_kinds:
         decrement_counter(entity_kind)
     
     return None
 
 
-def edit_property(entity_list, property, new_value):  
+def write_batch(put_list=(), delete_keys=(), transactional=False):
     """
-    Edits a single property of an entity.
-    
-    :params: 
-            entity_list (list) list of entities who's property is to be changed
-            property (string) property you want to change
-            new value value to change the property to
-            
-    :returns: None
-    """  
-    for e in entity_list:
-        if e:
-            e[property] = new_value
-            client.put(e)
-    return None
+    Saves and deletes entities using as few commits as possible. Mutations
+    are split into groups of max_mutations, Datastore's limit per commit.
+
+    :params:
+            put_list (list) entities to save
+            delete_keys (list) keys of entities to delete
+            transactional (bool) commit each group in a transaction, so the
+                        whole write is atomic if it fits in one group
+
+    :returns: rpcs (int) number of commit RPCs issued
+    """
+    mutations = [("put", e) for e in put_list] + \
+                [("delete", k) for k in delete_keys]
+    rpcs = 0
+    for i in range(0, len(mutations), c.max_mutations):
+        if transactional:
+            batch = client.transaction()
+        else:
+            batch = client.batch()
+        with batch:
+            for operation, m in mutations[i:i + c.max_mutations]:
+                if operation == "put":
+                    batch.put(bump_version(m))
+                else:
+                    batch.delete(m)
+        rpcs += 1
+    cache.invalidate([e.key for e in put_list])
+    cache.invalidate(delete_keys)
+    return rpcs
+
+
+def get_entities(keys):
+    """
+    Gets entities by key with get_multi in groups of max_lookup keys
+
+    :params:
+            keys (list) datastore keys
+
+    :returns: results (list) entities that were found
+    """
+    results = []
+    for i in range(0, len(keys), c.max_lookup):
+        results.extend(client.get_multi(keys[i:i + c.max_lookup]))
+    return results
                
                
+@profile.timed("datastore-query")
 def get_add_filter_query(entity_kind, query_list):
     """
     Perfoms datastore query with using add_filter.
@@ -224,6 +850,7 @@ def get_add_filter_query(entity_kind, query_list):
             
     :returns: results (list) list of query results based on filters
     """    
+    check_query(entity_kind, query_list)
     query = client.query(kind=entity_kind)
     for q in query_list:
         query.add_filter(q["property"], q["operator"], q["value"])
@@ -234,6 +861,388 @@ def get_add_filter_query(entity_kind, query_list):
     return results
 
 
+def get_loads_by_carrier(boat_ids):
+    """
+    Gets the loads carried by each boat in a list of boats using IN filters
+    so a page of boats costs one query instead of one query per boat.
+
+    :params:
+            boat_ids (list) ids of the boats to get loads for
+
+    :returns: results (dict) boat id to list of loads on that boat
+    """
+    results = {int(boat_id): [] for boat_id in boat_ids}
+    boat_ids = list(results)
+    for i in range(0, len(boat_ids), c.in_filter_limit):
+        query_list = [{"property": "carrier",
+                       "operator": "IN",
+                       "value": boat_ids[i:i + c.in_filter_limit]}]
+        for e in get_add_filter_query(c.loads, query_list):
+            results[e["carrier"]].append(e)
+
+    return results
+
+
+def iterate_keys(entity_kind, query_list, sort=None):
+    """
+    Yields the keys of every entity of kind that matches the filters in
+    groups of max_mutations, using a keys-only query and cursors
+
+    :params:
+            entity_kind (string) is the type of entity
+            query_list (list) list of filters in get_add_filter_query format
+            sort (string) property of the range filter, if there is one
+
+    :returns: generator of lists of datastore keys
+    """
+    check_query(entity_kind, query_list, sort)
+    q_cursor = None
+    while True:
+        query = client.query(kind=entity_kind)
+        for q in query_list:
+            query.add_filter(q["property"], q["operator"], q["value"])
+        query.keys_only()
+        result_iterator = query.fetch(limit=c.max_mutations,
+                                      start_cursor=q_cursor)
+        keys = [e.key for e in next(result_iterator.pages)]
+        if keys:
+            yield keys
+        q_cursor = result_iterator.next_page_token
+        if not q_cursor or not keys:
+            break
+
+
+def delete_expired(entity_kind, property, now):
+    """
+    Deletes entities of kind whose expiry property is before now, found
+    with a keys-only query on the property's built-in index. Entities saved
+    before the property was added are not in that index, so they are found
+    by comparing every key with the keys that have the property.
+
+    :params:
+            entity_kind (string) is the type of entity
+            property (string) property that holds the expiry time
+            now (datetime) current time
+
+    :returns: deleted (int) number of entities deleted
+    """
+    deleted = 0
+    expired = [{"property": property, "operator": "<", "value": now}]
+    for keys in iterate_keys(entity_kind, expired, property):
+        write_batch(delete_keys=keys)
+        deleted += len(keys)
+
+    # What is left with the property expires at or after now
+    unexpired = [{"property": property, "operator": ">=", "value": now}]
+    with_expiry = {key for keys in iterate_keys(entity_kind, unexpired,
+                                                property)
+                   for key in keys}
+    for keys in iterate_keys(entity_kind, []):
+        # Entities saved since with_expiry was read also look missing, so
+        # the few candidates are read to check they have no expiry
+        candidates = [key for key in keys if key not in with_expiry]
+        missing = [e.key for e in get_entities(candidates)
+                   if property not in e]
+        write_batch(delete_keys=missing)
+        deleted += len(missing)
+
+    return deleted
+
+
+def get_load_ids(boat):
+    """
+    Gets the ids of the loads on a boat. Boats saved before load_ids was
+    added fall back to a carrier query.
+
+    :params:
+            boat (datastore entity) boat entity
+
+    :returns: (list) load ids on the boat
+    """
+    if "load_ids" in boat:
+        return list(boat["load_ids"])
+    query_list = [{"property": "carrier",
+                   "operator": "=",
+                   "value": boat.key.id}]
+    return [e["id"] for e in get_add_filter_query(c.loads, query_list)]
+
+
+def get_boats_loads(boats):
+    """
+    Gets the loads on each boat in a list of boats with a single get_multi
+    by key using each boat's load_ids.
+
+    :params:
+            boats (list) boat entities
+
+    :returns: results (dict) boat id to list of loads on that boat
+    """
+    results = {}
+    load_keys = []
+    old_boat_ids = []
+    for boat in boats:
+        results[boat.key.id] = []
+        if "load_ids" in boat:
+            load_keys.extend(client.key(c.loads, load_id)
+                             for load_id in boat["load_ids"])
+        else:
+            old_boat_ids.append(boat.key.id)
+
+    if load_keys:
+        for e in get_entities(load_keys):
+            e["id"] = e.key.id
+            if e["carrier"] in results:
+                results[e["carrier"]].append(e)
+    if old_boat_ids:
+        results.update(get_loads_by_carrier(old_boat_ids))
+    for loads in results.values():
+        loads.sort(key=lambda e: e["id"])
+
+    return results
+
+
+def get_boat_loads(boat):
+    """
+    Gets the loads on one boat. Concurrent reads of the same version of a
+    boat share one lookup.
+
+    :params:
+            boat (datastore entity) boat entity
+
+    :returns: (list) loads on the boat
+    """
+    key = ("loads", boat.key.id, boat.get("version", 0))
+    return cache.single_flight(key, get_boats_loads, [boat])[boat.key.id]
+
+
+def run_transaction(func, *args):
+    """
+    Runs a function inside a transaction. If the commit conflicts with
+    another write the whole function is run again, up to
+    transaction_retries times.
+
+    :params:
+            func (function) reads and writes the entities, it must only
+                        change state it creates so it can be run again
+            *args arguments passed to func
+
+    :returns: value returned by func
+    :raises: exceptions.Conflict if every attempt conflicts
+    """
+    for attempt in range(c.transaction_retries):
+        try:
+            with client.transaction():
+                return func(*args)
+        except exceptions.Conflict:
+            if attempt == c.transaction_retries - 1:
+                raise
+
+
+def update_carrier(load_id, boat_id, assign):
+    """
+    Puts a load on a boat or takes it off by updating load carrier and boat
+    load_ids together in one transaction
+
+    :params:
+            load_id (int) id of load
+            boat_id (int) id of boat
+            assign (bool) True to put the load on the boat, False to remove it
+
+    :returns: (bool) False if the load or boat no longer exists, the load
+            is on another boat when assigning or is not on this boat when
+            removing, otherwise True
+    """
+    load_key = client.key(c.loads, load_id)
+    boat_key = client.key(c.boats, boat_id)
+    boat = client.get(boat_key)
+    if not boat:
+        return False
+    stored_load_ids = get_load_ids(boat)
+
+    def update():
+        load = client.get(load_key)
+        boat = client.get(boat_key)
+        if not load or not boat:
+            # Deleted since the route read them
+            return False
+        load_ids = list(boat.get("load_ids", stored_load_ids))
+        if assign:
+            if load["carrier"] and load["carrier"] != boat_id:
+                return False
+            load["carrier"] = boat_id
+            if load_id not in load_ids:
+                load_ids.append(load_id)
+        else:
+            if load["carrier"] != boat_id:
+                return False
+            load["carrier"] = None
+            if load_id in load_ids:
+                load_ids.remove(load_id)
+        boat["load_ids"] = load_ids
+        boat.exclude_from_indexes.add("load_ids")
+        client.put_multi([bump_version(load), bump_version(boat)])
+        return True
+
+    updated = run_transaction(update)
+    if updated:
+        cache.invalidate([load_key, boat_key])
+
+    return updated
+
+
+def assign_loads(load_ids, boat_id):
+    """
+    Puts many loads on a boat in one transaction. Loads that do not exist
+    or are on another boat are skipped.
+
+    :params:
+            load_ids (list) ids of loads
+            boat_id (int) id of boat
+
+    :returns: results (dict) load id to "assigned", "missing" or
+            "already_loaded", or None if the boat does not exist
+    """
+    boat_key = client.key(c.boats, boat_id)
+    boat = client.get(boat_key)
+    if not boat:
+        return None
+    stored_load_ids = get_load_ids(boat)
+    load_keys = [client.key(c.loads, load_id) for load_id in load_ids]
+
+    def assign():
+        results = {}
+        boat = client.get(boat_key)
+        if not boat:
+            return None
+        boat_load_ids = list(boat.get("load_ids", stored_load_ids))
+        loads = {e.key.id: e for e in client.get_multi(load_keys)}
+        put_list = [boat]
+        for load_id in load_ids:
+            load = loads.get(load_id)
+            if not load:
+                results[load_id] = "missing"
+            elif load["carrier"] and load["carrier"] != boat_id:
+                results[load_id] = "already_loaded"
+            else:
+                results[load_id] = "assigned"
+                load["carrier"] = boat_id
+                put_list.append(load)
+                if load_id not in boat_load_ids:
+                    boat_load_ids.append(load_id)
+        boat["load_ids"] = boat_load_ids
+        boat.exclude_from_indexes.add("load_ids")
+        client.put_multi([bump_version(e) for e in put_list])
+        return results
+
+    results = run_transaction(assign)
+    if results is None:
+        return None
+    cache.invalidate(load_keys + [boat_key])
+
+    return results
+
+
+def bump_carriers(loads):
+    """
+    Gives a new version to every boat carrying one of the loads, so the
+    boat's ETag changes when a load on it is edited
+
+    :params:
+            loads (list) load entities that were edited
+
+    :returns: None
+    """
+    boat_keys = [client.key(c.boats, boat_id)
+                 for boat_id in {e["carrier"] for e in loads
+                                 if e.get("carrier")}]
+
+    def bump(keys):
+        client.put_multi([bump_version(e) for e in client.get_multi(keys)])
+
+    for i in range(0, len(boat_keys), c.max_mutations):
+        run_transaction(bump, boat_keys[i:i + c.max_mutations])
+    cache.invalidate(boat_keys)
+
+    return None
+
+
+def delete_boat(boat_id):
+    """
+    Takes every load off a boat and deletes the boat. The boat is read and
+    deleted in one transaction with its first max_mutations - 1 loads, so a
+    load can not be put on it after its load_ids are read. Loads past that
+    are taken off in one transaction per group.
+
+    :params:
+            boat_id (int) id of boat
+
+    :returns: (bool) False if the boat was already deleted, otherwise True
+    """
+    boat_key = client.key(c.boats, boat_id)
+    boat = client.get(boat_key)
+    if not boat:
+        return False
+    stored_load_ids = get_load_ids(boat)
+
+    def unload(load_ids):
+        loads = [e for e in client.get_multi(
+                     [client.key(c.loads, load_id) for load_id in load_ids])
+                 if e.get("carrier") == boat_id]
+        for e in loads:
+            e["carrier"] = None
+        client.put_multi([bump_version(e) for e in loads])
+
+    def delete():
+        boat = client.get(boat_key)
+        if not boat:
+            return None
+        load_ids = list(boat.get("load_ids", stored_load_ids))
+        unload(load_ids[:c.max_mutations - 1])
+        client.delete(boat_key)
+        return load_ids
+
+    load_ids = run_transaction(delete)
+    if load_ids is None:
+        return False
+    for i in range(c.max_mutations - 1, len(load_ids), c.max_mutations):
+        run_transaction(unload, load_ids[i:i + c.max_mutations])
+    cache.invalidate([client.key(c.loads, load_id) for load_id in load_ids]
+                     + [boat_key])
+    decrement_counter(c.boats)
+
+    return True
+
+
+def delete_load(load_id):
+    """
+    Deletes a load and removes it from its carrier's load_ids in one
+    transaction
+
+    :params:
+            load_id (int) id of load
+
+    :returns: None
+    """
+    load_key = client.key(c.loads, load_id)
+
+    def delete():
+        changed_keys = [load_key]
+        load = client.get(load_key)
+        if load and load["carrier"]:
+            boat = client.get(client.key(c.boats, load["carrier"]))
+            if boat and load_id in boat.get("load_ids", []):
+                boat["load_ids"].remove(load_id)
+                client.put(bump_version(boat))
+                changed_keys.append(boat.key)
+        client.delete(load_key)
+        return changed_keys
+
+    cache.invalidate(run_transaction(delete))
+    decrement_counter(c.loads)
+
+    return None
+
+
 def add_id_self(e, req, entity_kind):
     """
     Adds self and id property to entity
@@ -254,6 +1263,39 @@ def add_id_self(e, req, entity_kind):
     return e
 
 
+def bump_version(entity):
+    """
+    Adds one to the version of a boat or load before it is saved. Entities
+    saved before versions were added start from 0.
+
+    :params:
+            entity (datastore entity) entity that is about to be saved
+
+    :returns: entity (datastore entity) entity that was passed
+    """
+    if entity.key.kind in c.versioned_kinds:
+        entity["version"] = entity.get("version", 0) + 1
+        entity.exclude_from_indexes.add("version")
+
+    return entity
+
+
+def get_etag(entity, *parts):
+    """
+    Makes a strong ETag from the kind, id and version of an entity
+
+    :params:
+            entity (datastore entity) boat or load entity
+            parts (strings) tell apart representations of the same entity,
+                        e.g. a boat and its list of loads
+
+    :returns: (string) unquoted ETag
+    """
+    tag = [entity.key.kind, str(entity.key.id_or_name),
+           str(entity.get("version", 0))]
+    return "-".join(tag + [str(part) for part in parts])
+
+
 def get_self_url(req, entity_kind, id=""):
     """
     Creates a url to access the resource that has the id passed
@@ -270,24 +1312,48 @@ def get_self_url(req, entity_kind, id=""):
     return url
 
 
-def repackage_carrier(entity, request):
+def get_counter_keys(entity_kind):
     """
-    Changes the carrier property to include two properties: self, id.
-    
-    :params: 
-            request (flask request) flask request to pull url information from
-            entity (datastore entity) entity to edit carrier property
-            
-    :returns: entity (datastore entity) entity that was passed
+    Gets the keys of every counter shard for kind passed
+
+    :params:
+            entity_kind (string) is the type of entity
+
+    :returns: (list) of datastore keys
     """
-    if not entity["carrier"]:
-        return entity
-    else:
-        carrier_id = entity["carrier"]
-        entity["carrier"] = {}
-        entity["carrier"]["id"] = carrier_id
-        entity["carrier"]["self"] = get_self_url(request, c.boats, carrier_id)
-        return entity
+    return [client.key(c.counter_kind, entity_kind + "-" + str(i))
+            for i in range(c.counter_shards)]
+
+
+def update_counter(entity_kind, amount):
+    """
+    Adds amount to one randomly chosen counter shard inside a transaction.
+    If the transaction conflicts it is retried on another shard.
+
+    :params:
+            entity_kind (string) is the type of entity
+            amount (int) number to add to the count, negative to subtract
+
+    :returns: None
+    """
+    shard_keys = get_counter_keys(entity_kind)
+    for attempt in range(c.transaction_retries):
+        shard_key = random.choice(shard_keys)
+        try:
+            with client.transaction():
+                shard = client.get(shard_key)
+                if not shard:
+                    shard = datastore.Entity(key=shard_key)
+                    shard.update({"kind": entity_kind, "count": 0})
+                shard["count"] = shard["count"] + amount
+                client.put(shard)
+            break
+        except exceptions.Conflict:
+            if attempt == c.transaction_retries - 1:
+                raise
+    with _count_lock:
+        _count_cache.pop(entity_kind, None)
+    return None
 
 
 def increment_counter(entity_kind):
@@ -299,9 +1365,7 @@ def increment_counter(entity_kind):
 
     :returns: None
     """
-    e = get_entity("counter", entity_kind)
-    e["count"] = e["count"] + 1
-    client.put(e)
+    update_counter(entity_kind, 1)
     return None
 
 
@@ -314,46 +1378,100 @@ def decrement_counter(entity_kind):
 
     :returns: None
     """
-    e = get_entity("counter", entity_kind)
-    e["count"] = e["count"] - 1
-    client.put(e)
+    update_counter(entity_kind, -1)
     return None
 
 
 def get_count(entity_kind):
     """
-    Get the number of entities of a certain kind
+    Get the number of entities of a certain kind by summing its counter
+    shards and the counter entity from before sharding, if it has not been
+    moved into the shards yet. Sums are cached for count_cache_ttl seconds.
 
     :params:
             entity_kind (string) is the type of entity
 
-    :returns:
+    :returns: (int) number of entities of kind
     """
-    e = get_entity("counter", entity_kind)
-    return e["count"]
+    now = time.time()
+    with _count_lock:
+        cached = _count_cache.get(entity_kind)
+        if cached and now < cached["expires"]:
+            return cached["count"]
+
+    shards = client.get_multi(get_counter_keys(entity_kind) +
+                              [get_old_counter_key(entity_kind)])
+    count = sum(shard["count"] for shard in shards)
+    with _count_lock:
+        _count_cache[entity_kind] = {"count": count,
+                                     "expires": now + c.count_cache_ttl}
+    return count
+
+
+def get_old_counter_key(entity_kind):
+    """
+    Gets the key of the single counter entity used before sharding
+
+    :params:
+            entity_kind (string) is the type of entity
+
+    :returns: (datastore key) counter key
+    """
+    return client.key("counter", entity_kind)
 
 
 def initialize_counter(entity_kind):
     """
-    Create counter for entities in kind
+    Moves a counter entity from before sharding into the first shard. Shards
+    may already hold changes made since, so the old count is added to the
+    shard and the old entity deleted in one transaction.
 
     :params:
             entity_kind (string) type of entity
 
     :returns: None
     """
-    e = get_entity("counter", entity_kind)
-    if e:
-        query = client.query(kind=entity_kind)
-        query.keys_only()
-        results = {entity_kind: list(query.fetch())}
-        e["count"] = len(results[entity_kind])
-        client.put(e)
-    else:
-        create_entity("counter", {"count": 0}, entity_kind)
+    old_key = get_old_counter_key(entity_kind)
+    shard_key = get_counter_keys(entity_kind)[0]
+
+    def migrate():
+        old_counter = client.get(old_key)
+        if not old_counter:
+            return
+        shard = client.get(shard_key)
+        if not shard:
+            shard = datastore.Entity(key=shard_key)
+            shard.update({"kind": entity_kind, "count": 0})
+        shard["count"] = shard["count"] + old_counter["count"]
+        client.put(shard)
+        client.delete(old_key)
+
+    run_transaction(migrate)
+    cache.invalidate([old_key])
+    with _count_lock:
+        _count_cache.pop(entity_kind, None)
     return None
 
 
+def reconcile_counter(entity_kind):
+    """
+    Fixes the counter for kind if it drifted from the number of entities,
+    counting them with a count aggregation instead of a keys-only scan
+
+    :params:
+            entity_kind (string) type of entity
+
+    :returns: difference (int) amount added to the counter
+    """
+    initialize_counter(entity_kind)
+    with _count_lock:
+        _count_cache.pop(entity_kind, None)
+    difference = get_query_count(entity_kind, []) - get_count(entity_kind)
+    if difference:
+        update_counter(entity_kind, difference)
+    return difference
+
+
 def remove_counter(entity_kind):
     """
     Remove counter for entity type
@@ -363,5 +1481,8 @@ def remove_counter(entity_kind):
 
     :returns: None
     """
-    delete_entity("counter", entity_kind)
+    client.delete_multi(get_counter_keys(entity_kind) +
+                        [get_old_counter_key(entity_kind)])
+    with _count_lock:
+        _count_cache.pop(entity_kind, None)
     return None
@@ -0,0 +1,134 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Shared HTTP session for outbound calls to Google with
+#              connection pooling, timeouts, retries and latency histograms
+#
+# Sources: requests HTTPAdapter and urllib3 Retry
+#          https://urllib3.readthedocs.io/en/1.26.x/reference/urllib3.util.html
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import threading
+import time
+import constants as c
+
+# Only GET is retried after a read error or retry status. A POST, e.g. the
+# OAuth code exchange, is single use so it is only retried when the
+# connection failed before the request was sent.
+retry = Retry(total=c.http_retries, backoff_factor=c.http_backoff,
+              status_forcelist=c.http_retry_statuses,
+              allowed_methods=frozenset(["GET"]),
+              raise_on_status=False)
+adapter = HTTPAdapter(pool_connections=c.http_pool_connections,
+                      pool_maxsize=c.http_pool_size, max_retries=retry)
+session = requests.Session()
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+_histogram_lock = threading.Lock()
+_histograms = {}
+
+
+def get(url, **kwargs):
+    """
+    Sends a GET request with the shared session
+
+    :params:
+            url (string) url to request
+            kwargs keyword arguments passed to requests
+
+    :returns: (requests response) response
+    """
+    return send("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Sends a POST request with the shared session
+
+    :params:
+            url (string) url to request
+            kwargs keyword arguments passed to requests
+
+    :returns: (requests response) response
+    """
+    return send("POST", url, **kwargs)
+
+
+def send(method, url, **kwargs):
+    """
+    Sends a request with the shared session using the connect and read
+    timeouts in constants unless a timeout is passed, and records how long
+    it took
+
+    :params:
+            method (string) HTTP method
+            url (string) url to request
+            kwargs keyword arguments passed to requests
+
+    :returns: (requests response) response
+    """
+    kwargs.setdefault("timeout", (c.http_connect_timeout,
+                                  c.http_read_timeout))
+    start = time.perf_counter()
+    try:
+        return session.request(method, url, **kwargs)
+    finally:
+        record_latency(get_endpoint(url), time.perf_counter() - start)
+
+
+def get_endpoint(url):
+    """
+    Gets the host and path of a url without the query string
+
+    :params:
+            url (string) url of the request
+
+    :returns: (string) endpoint name
+    """
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
+
+
+def record_latency(endpoint, seconds):
+    """
+    Adds a request time to the histogram for an endpoint
+
+    :params:
+            endpoint (string) endpoint name
+            seconds (float) time the request took
+
+    :returns: None
+    """
+    with _histogram_lock:
+        histogram = _histograms.get(endpoint)
+        if not histogram:
+            histogram = {"buckets": [0] * (len(c.http_latency_buckets) + 1),
+                         "count": 0,
+                         "sum": 0.0}
+            _histograms[endpoint] = histogram
+        for i, bound in enumerate(c.http_latency_buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(c.http_latency_buckets)
+        histogram["buckets"][i] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+    return None
+
+
+def get_latency_histograms():
+    """
+    Gets request time histograms for each endpoint
+
+    :returns: (dict) endpoint to bucket upper bounds in seconds, counts per
+            bucket (the last bucket has no upper bound), count and sum
+    """
+    with _histogram_lock:
+        return {endpoint: {"bounds": list(c.http_latency_buckets),
+                           "buckets": list(h["buckets"]),
+                           "count": h["count"],
+                           "sum": h["sum"]}
+                for endpoint, h in _histograms.items()}
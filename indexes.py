@@ -0,0 +1,23 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Writes index.yaml from the query catalog in datastoreHelpers
+#              or, with --check, exits with status 1 if index.yaml is out of
+#              date so it can run in CI before a deploy
+#
+# Sources: Datastore index configuration
+#          https://cloud.google.com/datastore/docs/tools/indexconfig
+import sys
+import constants as c
+import datastoreHelpers as ds
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv[1:]:
+        if not ds.check_index_file():
+            print(c.index_file + " is out of date, run python indexes.py")
+            sys.exit(1)
+        print(c.index_file + " is up to date")
+    else:
+        with open(c.index_file, "w") as index_file:
+            index_file.write(ds.get_index_yaml())
+        print("Wrote " + c.index_file)
@@ -4,13 +4,15 @@
 #
 # Sources: OSU CS493 Module 4 Exploration
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
-from flask import abort, request, Blueprint
-import json
+from flask import abort, request, Blueprint, Response, stream_with_context
+import responseHelpers as r
 import constants as c
 import datastoreHelpers as ds
 import methodHelpers as m
 
 bp = Blueprint('load', __name__, url_prefix='/loads')
+# url_prefix always adds a slash so /loads:batch needs its own blueprint
+batch_bp = Blueprint('load_batch', __name__)
 
 
 @bp.route('', methods=['POST', 'GET'])
@@ -25,27 +27,110 @@ def loads_get_post():
         content = request.get_json()  
         if len(content) != 3:
             abort(400, {"message": c.edit_errors["missing_attribute"]})
+        if m.has_hidden_property(content):
+            abort(403, description=c.edit_errors["hidden_property"])
         content["carrier"] = None   
         new_load = ds.create_entity(c.loads, content)
-        new_load["id"] = new_load.key.id
-        new_load["self"] = ds.get_self_url(request, c.loads,
-                                           new_load["id"])
-        return new_load, 201
+        return r.json_response(r.load_record(new_load), 201,
+                               m.get_etag_header(ds.get_etag(new_load)))
         
     elif request.method == 'GET':
-        results = ds.get_all(c.loads, request)
-        for e in results["loads"]:
-            e["self"] = ds.get_self_url(request, c.loads, e["id"])
-            e = ds.repackage_carrier(e, request)
-        return json.dumps(results), 200
+        page = m.get_page_options(request, c.loads)
+        if page["filters"]:
+            results = ds.get_filter_query(c.loads, page["filters"], request,
+                                          page)
+        else:
+            # The total of every load comes from the counter
+            results = ds.get_all(c.loads, request, page)
+        records = [r.load_record(e, page["fields"]) for e in results["loads"]]
+        return r.list_response(results, c.loads, records)
         
     else:
         abort(405)
 
 
-@bp.route('/<id>', methods=['GET', 'DELETE', 'PATCH', 'PUT'])
+@batch_bp.route('/loads:batch', methods=['POST'])
+def loads_batch_post():
+    # Validate correct accept type
+    if not request.accept_mimetypes.accept_json:
+        abort(406)
+
+    # Sort items into new loads, updates of existing loads, and errors
+    content = m.get_batch_content(request)
+    results = [None] * len(content)
+    new_items = []
+    update_items = []
+    update_ids = set()
+    for i, item in enumerate(content):
+        if not isinstance(item, dict):
+            results[i] = {"status": 400,
+                          "Error": c.batch_errors["invalid_batch"]}
+        elif "carrier" in item:
+            results[i] = {"status": 403,
+                          "Error": c.load_errors["change_carrier"]}
+        elif m.has_hidden_property(item):
+            results[i] = {"status": 403,
+                          "Error": c.edit_errors["hidden_property"]}
+        elif "id" in item and isinstance(item["id"], int) and \
+                not isinstance(item["id"], bool) and len(item) == 4:
+            # A load can only be written once per commit
+            if item["id"] in update_ids:
+                results[i] = {"status": 400,
+                              "Error": c.batch_errors["duplicate_id"]}
+            else:
+                update_ids.add(item["id"])
+                update_items.append(i)
+        elif "id" not in item and len(item) == 3:
+            new_items.append(i)
+        else:
+            results[i] = {"status": 400,
+                          "Error": c.edit_errors["missing_attribute"]}
+
+    # Create new loads with one id allocation and batched puts
+    new_contents = [dict(content[i], carrier=None) for i in new_items]
+    new_loads = ds.create_entities(c.loads, new_contents)
+    for i, e in zip(new_items, new_loads):
+        results[i] = {"status": 201, "id": e.key.id,
+                      "self": r.get_self_url(c.loads, e.key.id)}
+
+    # Replace existing loads, reading and writing each group in a
+    # transaction
+    edits = {content[i]["id"]: {k: v for k, v in content[i].items()
+                                if k != "id"}
+             for i in update_items}
+    edited_loads = ds.edit_entities(c.loads, edits)
+    edited_ids = {e.key.id for e in edited_loads}
+    for i in update_items:
+        load_id = content[i]["id"]
+        if load_id in edited_ids:
+            results[i] = {"status": 200, "id": load_id,
+                          "self": r.get_self_url(c.loads, load_id)}
+        else:
+            results[i] = {"status": 404,
+                          "Error": c.load_errors["invalid_load_id"]}
+    ds.bump_carriers(edited_loads)
+
+    return r.json_response({"loads": results})
+
+
+@bp.route('/export', methods=['GET'])
+def loads_export():
+    # Validate correct accept type
+    if not request.accept_mimetypes.accept_json and \
+            not request.accept_mimetypes[c.ndjson]:
+        abort(406)
+
+    def generate():
+        # Stream one load per line while paging through Datastore
+        for e in ds.iterate_query(c.loads, []):
+            yield r.dumps(r.load_record(e)) + b"\n"
+
+    return Response(stream_with_context(generate()), 200, mimetype=c.ndjson)
+
+
+@bp.route('/<int:id>', methods=['GET', 'DELETE', 'PATCH', 'PUT'])
 def load_get_delete_patch_put(id):
-    load = ds.get_entity(c.loads, int(id))
+    load = ds.get_entity(c.loads, id)
     if not load:
         abort(404, {"message": c.load_errors["invalid_load_id"]})
 
@@ -54,20 +139,25 @@ def load_get_delete_patch_put(id):
         if not request.accept_mimetypes.accept_json:
             abort(406)
 
-        load = ds.add_id_self(load, request, c.loads)
-        load = ds.repackage_carrier(load, request)
-        return json.dumps(load), 200
+        # Skip serializing when the client has the current version
+        etag = ds.get_etag(load)
+        if m.is_not_modified(request, etag):
+            return '', 304, m.get_etag_header(etag)
+        return r.json_response(r.load_record(load), 200,
+                               m.get_etag_header(etag))
   
     elif request.method == 'DELETE':
-        ds.delete_entity(c.loads, int(id))
+        ds.delete_load(id)
         return '', 204
 
     elif request.method == 'PATCH':
-        edited_load = m.run_patch(request, c.loads, id)
-        return edited_load, 200
+        edited_load, etag = m.run_patch(request, c.loads, id)
+        return r.json_response(r.load_record(edited_load), 200,
+                               m.get_etag_header(etag))
 
     elif request.method == 'PUT':
-        edited_load = m.run_put(request, c.loads, id)
-        return edited_load, 200
+        edited_load, etag = m.run_put(request, c.loads, id)
+        return r.json_response(r.load_record(edited_load), 200,
+                               m.get_etag_header(etag))
     else:
         abort(405)
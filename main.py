@@ -5,26 +5,85 @@
 #
 # Sources: OSU CS493 Module 4 Exploration
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
-import boat
-import load
-import oauth
-import users
-from flask import Flask, request, render_template, make_response
+from importlib import import_module
+import time
+
+startup_report = {"imports_ms": {}}
+startup_start = time.perf_counter()
+
+
+def timed_import(name):
+    """
+    Imports a module and records how long it took in the startup report
+
+    :params:
+            name (string) module name
+
+    :returns: module
+    """
+    start = time.perf_counter()
+    module = import_module(name)
+    startup_report["imports_ms"][name] = \
+        round((time.perf_counter() - start) * 1000, 2)
+    return module
+
+
+# Imported in dependency order so each time is for that module only
+flask = timed_import("flask")
+c = timed_import("constants")
+profile = timed_import("profileHelpers")
+ds = timed_import("datastoreHelpers")
+timed_import("httpHelpers")
+timed_import("authHelpers")
+timed_import("rateLimitHelpers")
+timed_import("methodHelpers")
+timed_import("responseHelpers")
+oauth = timed_import("oauth")
+boat = timed_import("boat")
+load = timed_import("load")
+users = timed_import("users")
+admin = timed_import("admin")
+from flask import Flask, request, render_template, make_response, g
 import json
-import datastoreHelpers as ds
-import constants as c
-import re
+from functools import lru_cache
 
 app = Flask(__name__)
 app.register_blueprint(boat.bp)
 app.register_blueprint(load.bp)
+app.register_blueprint(load.batch_bp)
 app.register_blueprint(oauth.bp)
 app.register_blueprint(users.bp)
+app.register_blueprint(admin.bp)
 
+# Counters are reconciled and expired oauth states deleted by the
+# /admin/counters and /admin/states cron jobs, see cron.yaml
 #ds.remove_counter(c.boats)
 #ds.remove_counter(c.loads)
-ds.initialize_counter(c.loads)
-ds.initialize_counter(c.boats)
+
+
+@app.before_request
+def start_profile():
+    profile.start_request()
+    g.profiler = None
+    if request.args.get("profile") == "1" and \
+            oauth.is_admin(request.headers.get("Authorization")):
+        g.profiler = profile.start_profiler()
+
+
+@app.after_request
+def end_profile(response):
+    stats = profile.end_request()
+    if g.get("profiler"):
+        summary = profile.get_profile_summary(g.profiler, c.profile_lines)
+        response = make_response(summary, 200)
+        response.mimetype = "text/plain"
+    if stats:
+        response.headers.set("Server-Timing", profile.get_server_timing(stats))
+        route = request.url_rule.rule if request.url_rule else request.path
+        print(profile.get_log_entry(stats, route, request.method,
+                                    response.status_code))
+    return response
+
 
 @app.route('/')
 def index():
@@ -32,24 +91,51 @@ def index():
     return render_template("index.html", link_url=login_url), 200
 
 
+@lru_cache(maxsize=c.error_cache_size)
+def get_error_body(error_message):
+    """
+    Serializes an error message once and reuses it for later responses
+
+    :params:
+            error_message (string) message for the Error property
+
+    :returns: (string) JSON error body
+    """
+    return json.dumps({"Error": error_message})
+
+
+@lru_cache(maxsize=c.error_cache_size)
+def get_allowed_methods(path):
+    """
+    Gets the Allow header value for a path by matching it against the
+    routes the way werkzeug does, including each rule's converters
+
+    :params:
+            path (string) request path
+
+    :returns: (string) comma separated methods allowed for the path
+    """
+    methods = url_adapter.allowed_methods(path)
+    return ", ".join(method for method in c.method_order if method in methods)
+
+
 @app.errorhandler(400)
 def handle_bad_request(error):
     if "message" not in error.description:
         error_message = ""
     else:
         error_message = error.description['message']
-    return json.dumps({"Error": error_message}), 400
+    return get_error_body(error_message), 400
 
 
 @app.errorhandler(401)
-def handle_not_found(error):
-    error_message = json.dumps({"Error": error.description['message']})
-    return error_message, 401
+def handle_unauthorized(error):
+    return get_error_body(error.description['message']), 401
 
 
 @app.errorhandler(403)
-def handle_not_found(error):
-    return json.dumps({"Error": error.description}), 403
+def handle_forbidden(error):
+    return get_error_body(error.description), 403
 
 
 @app.errorhandler(404)
@@ -58,33 +144,60 @@ def handle_not_found(error):
         error_message = "Page not found"
     else:
         error_message = error.description['message']
-    return json.dumps({"Error": error_message}), 404
+    return get_error_body(error_message), 404
 
 
 @app.errorhandler(405)
 def handle_method_not_allowed(error):
-    is_load = re.search("/loads/", request.path)
-    is_boat = re.search("/boats/", request.path)
-    allowed_methods = ""
-
-    response = make_response(json.dumps({"Error": error.description}))
-    if request.path == "/boats" or request.path == "/loads":
-        allowed_methods = "POST, GET"
-    elif is_boat or is_load:
-        allowed_methods = "GET, DELETE, PATCH, PUT"
-    elif is_boat and is_load:
-        allowed_methods = "DELETE, PUT"
-    elif request.path == "/oauth" or request.path == "/users":
-        allowed_methods = "GET"
-    response.headers.set('Allow', allowed_methods)
+    response = make_response(get_error_body(error.description))
+    response.headers.set('Allow', get_allowed_methods(request.path))
     response.status_code = 405
     return response
 
 
 @app.errorhandler(406)
-def handle_not_found(error):
-    error_message = json.dumps({"Error": c.oauth_errors["accept_type"]})
-    return error_message, 406
+def handle_not_acceptable(error):
+    return get_error_body(c.oauth_errors["accept_type"]), 406
+
+
+@app.errorhandler(ds.exceptions.Conflict)
+def handle_conflict(error):
+    # Transactions that still conflict after transaction_retries attempts
+    return get_error_body(c.edit_errors["conflict"]), 409
+
+
+@app.errorhandler(412)
+def handle_precondition_failed(error):
+    return get_error_body(error.description), 412
+
+
+@app.errorhandler(429)
+def handle_too_many_requests(error):
+    response = make_response(get_error_body(error.description))
+    response.headers.set('Retry-After', str(error.retry_after))
+    response.status_code = 429
+    return response
+
+
+@app.errorhandler(503)
+def handle_service_unavailable(error):
+    return get_error_body(error.description), 503
+
+
+# Bound once after every route is registered
+url_adapter = app.url_map.bind("")
+
+# Queries missing from index.yaml fail or run slowly once deployed
+startup_report["index_yaml_current"] = ds.check_index_file()
+if not startup_report["index_yaml_current"]:
+    print(json.dumps({"severity": "WARNING",
+                      "message": c.index_file + " does not match the query "
+                                 "catalog, run python indexes.py"}))
+
+startup_report["total_ms"] = \
+    round((time.perf_counter() - startup_start) * 1000, 2)
+app.config["STARTUP_REPORT"] = startup_report
+print("Startup report: " + json.dumps(startup_report))
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@
 import datastoreHelpers as ds
 import constants as c
 from flask import abort
+from werkzeug.http import quote_etag
+import json
 
 
 def in_patch_bounds(length):
@@ -40,7 +42,7 @@ def run_patch(request, entity_kind, id):
             entity_kind (string) is the type of entity
             request (flask request) flask request to pull url information from
             id (int) id of entity to be changed
-    :returns: datastore entity entity that was edited
+    :returns: datastore entity entity that was edited and its ETag
     """
     edited_entity = run_edit(in_patch_bounds, request, entity_kind, id)
     return edited_entity
@@ -54,7 +56,7 @@ def run_put(request, entity_kind, id):
             entity_kind (string) is the type of entity
             request (flask request) flask request to pull url information from
             id (int) id of entity to be changed
-    :returns: datastore entity entity that was edited
+    :returns: datastore entity entity that was edited and its ETag
     """
     edited_entity = run_edit(in_put_bounds, request, entity_kind, id)
     return edited_entity
@@ -70,7 +72,7 @@ def run_edit(in_bounds, request, entity_kind, id):
             entity_kind (string) is the type of entity
             request (flask request) flask request to pull url information from
             id (int) id of entity to be changed
-    :returns: datastore entity entity that was edited
+    :returns: datastore entity entity that was edited and its ETag
     """
     # Validate correct accept type
     if not request.accept_mimetypes.accept_json:
@@ -85,10 +87,207 @@ def run_edit(in_bounds, request, entity_kind, id):
             abort(400, {"message": c.edit_errors["missing_attribute"]})
     elif "carrier" in content:
         abort(403, description=c.load_errors["change_carrier"])
+    elif has_hidden_property(content):
+        abort(403, description=c.edit_errors["hidden_property"])
 
-    # Update and Return Entity
-    entity = ds.get_entity(entity_kind, int(id))
-    edited_entity = ds.edit_entity(entity, content)
-    edited_entity = ds.add_id_self(edited_entity, request, entity_kind)
+    # Update and Return Entity, If-Match is checked in the transaction
+    entity = ds.get_entity(entity_kind, id)
+    edited_entity = ds.edit_entity(entity, content, request.if_match or None)
+    if edited_entity is None:
+        abort(412, description=c.edit_errors["etag_mismatch"])
 
-    return edited_entity
+    return edited_entity, ds.get_etag(edited_entity)
+
+
+def has_hidden_property(content):
+    """
+    Checks if request content sets a property only the server writes, e.g.
+    version which ETags are made from
+
+    :params:
+            content (dict) JSON request content
+    :returns: bool true if content has a hidden property otherwise false
+    """
+    return any(k in content for k in c.hidden_properties)
+
+
+def is_not_modified(request, etag):
+    """
+    Checks if the request's If-None-Match has the current ETag
+
+    :params:
+            request (flask request) flask request to pull headers from
+            etag (string) unquoted ETag of the resource
+    :returns: bool true if a 304 can be sent otherwise false
+    """
+    return request.if_none_match.contains_weak(etag)
+
+
+def get_etag_header(etag):
+    """
+    Makes response headers with an ETag
+
+    :params:
+            etag (string) unquoted ETag of the resource
+    :returns: (dict) headers
+    """
+    return {"ETag": quote_etag(etag)}
+
+
+def get_page_options(request, entity_kind, query_list=()):
+    """
+    Reads the limit, sort, cursor, before and filter query parameters for a
+    page
+
+    :params:
+            request (flask request) flask request to pull url information from
+            entity_kind (string) is the type of entity
+            query_list (list) filters the route always adds, e.g. owner
+    :returns: page (dict) page options for datastoreHelpers.get_page, with
+            the route's and the request's filters in filters
+    """
+    page = {"limit": c.limit, "sort": None, "descending": False,
+            "cursor": None, "before": None,
+            "fields": get_fields(request, entity_kind)}
+    try:
+        page["limit"] = int(request.args.get("limit", c.limit))
+    except ValueError:
+        abort(400, {"message": c.page_errors["invalid_limit"]})
+    if page["limit"] < 1 or page["limit"] > c.max_limit:
+        abort(400, {"message": c.page_errors["invalid_limit"]})
+
+    sort = request.args.get("sort")
+    if sort:
+        page["descending"] = sort.startswith("-")
+        sort = sort.lstrip("-")
+        if sort not in c.sort_properties[entity_kind]:
+            abort(400, {"message": c.page_errors["invalid_sort"]})
+        page["sort"] = sort
+
+    try:
+        for direction in ("cursor", "before"):
+            if request.args.get(direction):
+                page[direction] = ds.decode_cursor(request.args[direction])
+    except ValueError:
+        abort(400, {"message": c.page_errors["invalid_cursor"]})
+
+    page["filters"] = list(query_list) + get_filters(request, entity_kind)
+    ranges = ds.get_filter_properties(page["filters"])[1]
+    if len(ranges) > 1:
+        abort(400, {"message": c.page_errors["range_sort"]})
+    elif ranges and page["sort"] is None:
+        # Sort by the range property since Datastore requires it
+        page["sort"] = ranges.pop()
+    elif ranges and page["sort"] not in ranges:
+        abort(400, {"message": c.page_errors["range_sort"]})
+    if not ds.find_query_shape(entity_kind, page["filters"], page["sort"],
+                               paged=True):
+        abort(400, {"message": c.page_errors["unsupported_query"]})
+
+    return page
+
+
+def get_filters(request, entity_kind):
+    """
+    Reads filter query parameters. Equality properties take a value, e.g.
+    ?type=Tanker or ?carrier=null. Range properties take gt:, gte:, lt: or
+    lte: and a number and can be repeated, e.g. ?volume=gt:10&volume=lte:50.
+    A plain number on a range property matches it exactly.
+
+    :params:
+            request (flask request) flask request to pull url information from
+            entity_kind (string) is the type of entity
+    :returns: filters (list) filters in get_add_filter_query format
+    """
+    filters = []
+    properties = c.filter_properties[entity_kind]
+    for name in properties["equal"]:
+        for value in request.args.getlist(name):
+            filters.append({"property": name, "operator": "=",
+                            "value": get_filter_value(name, value)})
+    for name in properties["range"]:
+        for value in request.args.getlist(name):
+            operators = [">=", "<="]
+            for prefix, operator in c.range_operators.items():
+                if value.startswith(prefix):
+                    operators = [operator]
+                    value = value[len(prefix):]
+                    break
+            try:
+                number = json.loads(value)
+            except ValueError:
+                number = None
+            if isinstance(number, bool) or \
+                    not isinstance(number, (int, float)):
+                abort(400, {"message": c.page_errors["invalid_filter"]})
+            for operator in operators:
+                filters.append({"property": name, "operator": operator,
+                                "value": number})
+
+    return filters
+
+
+def get_filter_value(name, value):
+    """
+    Converts an equality filter value to the type it is stored as
+
+    :params:
+            name (string) filtered property
+            value (string) query parameter value
+    :returns: value stored value, carrier is a boat id or None
+    """
+    if name != "carrier":
+        return value
+    elif value.lower() in ("null", "none"):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, {"message": c.page_errors["invalid_filter"]})
+
+
+def get_fields(request, entity_kind):
+    """
+    Reads the fields query parameter that picks which fields are returned
+
+    :params:
+            request (flask request) flask request to pull url information from
+            entity_kind (string) is the type of entity
+    :returns: fields (list) fields to return or None for every field
+    """
+    if "fields" not in request.args:
+        return None
+    fields = []
+    for field in request.args["fields"].split(","):
+        field = field.strip()
+        if field not in c.response_fields[entity_kind]:
+            abort(400, {"message": c.page_errors["invalid_fields"]})
+        if field not in fields:
+            fields.append(field)
+
+    return fields
+
+
+def get_batch_content(request):
+    """
+    Reads a batch request body that is a JSON array or NDJSON with one
+    object per line
+
+    :params:
+            request (flask request) flask request to pull content from
+    :returns: content (list) items in the batch
+    """
+    try:
+        if request.mimetype == c.ndjson:
+            lines = request.get_data(as_text=True).splitlines()
+            content = [json.loads(line) for line in lines if line.strip()]
+        else:
+            content = request.get_json()
+    except ValueError:
+        abort(400, {"message": c.batch_errors["invalid_batch"]})
+    if not isinstance(content, list):
+        abort(400, {"message": c.batch_errors["invalid_batch"]})
+    if len(content) > c.max_batch_size:
+        abort(400, {"message": c.batch_errors["batch_size"]})
+
+    return content
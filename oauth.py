@@ -6,14 +6,16 @@
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
 from flask import request, render_template, redirect, abort, \
     Blueprint, make_response
-from google.oauth2 import id_token
 from google.auth import exceptions
-from google.auth.transport import requests as g_req
-import requests
-import random
+import secrets
 import json
 import constants as c
 import datastoreHelpers as ds
+import authHelpers as auth
+import rateLimitHelpers as limits
+import httpHelpers as http
+import profileHelpers as profile
+import requests
 from urllib.parse import urlencode
 import datetime as dt
 
@@ -28,38 +30,36 @@ def oauth_get():
             abort(401, {"message": request.args["error"]})
         if not request.args.get("code"):
 
-            # Generate Random State, Verify it's Unique and Store in Database
-            random.seed()
-            while True:
-                state = ""
-                for i in range(c.state_size):
-                    state = state + random.choice(c.allowed_chars)
-                query = [
-                    {"property": "state", "operator": "=", "value": state}]
-                oauth_entity = ds.get_add_filter_query("oauth", query)
-                if not oauth_entity:
-                    break
-            oauth_entity = ds.create_entity("oauth", {"state": state})
+            # Generate Random State and Store it in Database as the Key
+            # 32 random bytes make a collision negligible so no check needed
+            state = secrets.token_urlsafe(c.state_bytes)
+            expires = dt.datetime.now(dt.timezone.utc) + \
+                dt.timedelta(seconds=c.state_ttl)
+            ds.create_entity("oauth", {"expires": expires}, state)
 
             # Send Request for Access Code
-            payload = c.oauth_params
+            payload = dict(c.oauth_params)
             payload["state"] = state
             url_with_params = c.oauth_url + "?" + urlencode(payload)
             return redirect(url_with_params, code=303)
 
         elif request.args.get("state") and request.args.get("code"):
             # Check State and Send Request for Token
-            query = [{"property": "state",
-                      "operator": "=",
-                      "value": request.args["state"]}]
-            oauth_entity = ds.get_add_filter_query("oauth", query)
-            if not oauth_entity:
+            state = request.args["state"]
+            oauth_entity = ds.get_entity("oauth", state)
+            # States saved before they had an expiry are not accepted
+            if not oauth_entity or "expires" not in oauth_entity or \
+                    oauth_entity["expires"] < dt.datetime.now(dt.timezone.utc):
                 abort(401, {"message": c.oauth_errors["state_error"]})
 
-            payload = c.oauth_data
+            payload = dict(c.oauth_data)
             payload["code"] = request.args["code"]
-            res = requests.post(c.token_url, data=payload,
+            try:
+                res = http.post(c.token_url, data=payload,
                                 headers=c.token_req_headers)
+            except requests.RequestException as e:
+                print(e)
+                abort(503, description=c.oauth_errors["google_unavailable"])
             res_content = json.loads(res.text)
             jwt_token = res_content["id_token"]
             if "error" in res_content:
@@ -70,14 +70,18 @@ def oauth_get():
             # Get First and Last Name and State
             api_headers = {"Authorization": res_content["token_type"] + " "
                                             + res_content["access_token"]}
-            res = requests.get(c.names_url, headers=api_headers)
+            try:
+                res = http.get(c.names_url, headers=api_headers)
+            except requests.RequestException as e:
+                print(e)
+                abort(503, description=c.oauth_errors["google_unavailable"])
 
             if res.status_code != 200:
                 return res.text, res.status_code
 
             # Verify JWT
-            id_info = id_token.verify_oauth2_token(jwt_token, g_req.Request(),
-                                                   c.oauth_params["client_id"])
+            id_info = auth.verify_oauth2_token(jwt_token,
+                                               c.oauth_params["client_id"])
             res_content = json.loads(res.text)
             res_content = res_content["names"][0]
             context = {"first_name": res_content["givenName"],
@@ -89,13 +93,14 @@ def oauth_get():
             context["user_id"] = id_info['sub']
 
             # Delete oauth Entity
-            ds.delete_entity("oauth", oauth_entity[0].key.id)
+            ds.delete_entity("oauth", state)
             return render_template("profile.html", context=context), 200
     else:
         abort(405)
     return
 
 
+@profile.timed("verify_jwt")
 def verify_jwt(jwt):
     if not jwt:
         abort(401, {"message": c.oauth_errors["missing_jwt"]})
@@ -103,9 +108,7 @@ def verify_jwt(jwt):
         jwt = jwt.replace('Bearer ', '')
         # Verify JWT
         try:
-            id_info = id_token.verify_oauth2_token(jwt, g_req.Request(),
-                                                   c.oauth_params["client_id"])
-            user_id = id_info['sub']
+            user_id = auth.verify_token(jwt, c.oauth_params["client_id"])
         except ValueError as e:
             print(e)
             abort(401, {"message": c.oauth_errors["invalid_or_expired_jwt"]})
@@ -113,4 +116,29 @@ def verify_jwt(jwt):
             print(e)
             abort(401, {"message": c.oauth_errors["invalid_jwt"]})
 
+    # Rate limit each user across every route that needs a JWT
+    retry_after = limits.take(user_id)
+    if retry_after:
+        abort(429, description=c.rate_limit_errors["too_many_requests"],
+              retry_after=retry_after)
+
     return user_id
+
+
+def is_admin(jwt):
+    """
+    Checks if a JWT belongs to a user listed in admin_users
+
+    :params:
+            jwt (string) Authorization header value
+
+    :returns: bool true if the JWT is valid and its sub is an admin
+    """
+    if not jwt:
+        return False
+    try:
+        user_id = auth.verify_token(jwt.replace('Bearer ', ''),
+                                    c.oauth_params["client_id"])
+    except (ValueError, exceptions.GoogleAuthError):
+        return False
+    return user_id in c.admin_users
@@ -0,0 +1,171 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Request profiling. Records Datastore RPCs by operation, time
+#              spent verifying JWTs and serializing responses, and reports
+#              them as Server-Timing headers and structured logs
+#
+# Sources: Server-Timing header
+#          https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+from contextvars import ContextVar
+from functools import wraps
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+
+_request_stats = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    """
+    Counts and total time in milliseconds for each timed operation in one
+    request. Reads on other threads add to the same object.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def add(self, name, milliseconds):
+        with self.lock:
+            timing = self.timings.setdefault(name, {"count": 0, "ms": 0.0})
+            timing["count"] += 1
+            timing["ms"] += milliseconds
+
+
+def start_request():
+    """
+    Starts recording for the current request
+
+    :returns: stats (RequestStats) stats for the request
+    """
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def end_request():
+    """
+    Stops recording for the current request
+
+    :returns: stats (RequestStats) stats for the request or None
+    """
+    stats = _request_stats.get()
+    _request_stats.set(None)
+    return stats
+
+
+def record(name, milliseconds):
+    """
+    Adds a timed operation to the current request if one is being recorded
+
+    :params:
+            name (string) operation name e.g. datastore-get
+            milliseconds (float) time the operation took
+
+    :returns: None
+    """
+    stats = _request_stats.get()
+    if stats:
+        stats.add(name, milliseconds)
+    return None
+
+
+def timed(name):
+    """
+    Decorator that records the time of each call as operation name
+
+    :params:
+            name (string) operation name
+
+    :returns: decorator
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
+
+
+def get_server_timing(stats):
+    """
+    Formats request stats as a Server-Timing header value
+
+    :params:
+            stats (RequestStats) stats for the request
+
+    :returns: (string) header value
+    """
+    total = (time.perf_counter() - stats.start) * 1000
+    metrics = []
+    with stats.lock:
+        for name, timing in sorted(stats.timings.items()):
+            metrics.append('{};dur={:.2f};desc="{} calls"'.format(
+                name, timing["ms"], timing["count"]))
+    metrics.append("total;dur={:.2f}".format(total))
+    return ", ".join(metrics)
+
+
+def get_log_entry(stats, route, method, status):
+    """
+    Makes a structured log entry for a request
+
+    :params:
+            stats (RequestStats) stats for the request
+            route (string) matched url rule
+            method (string) HTTP method
+            status (int) response status code
+
+    :returns: (string) JSON log line
+    """
+    with stats.lock:
+        timings = {name: {"count": timing["count"],
+                          "ms": round(timing["ms"], 2)}
+                   for name, timing in stats.timings.items()}
+    rpcs = sum(timing["count"] for name, timing in timings.items()
+               if name.startswith("datastore-"))
+    return json.dumps({"severity": "INFO",
+                       "message": "request profile",
+                       "route": route,
+                       "method": method,
+                       "status": status,
+                       "datastore_rpcs": rpcs,
+                       "timings": timings,
+                       "total_ms": round((time.perf_counter() - stats.start)
+                                         * 1000, 2)})
+
+
+def start_profiler():
+    """
+    Starts cProfile for the current request
+
+    :returns: profiler (cProfile.Profile)
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def get_profile_summary(profiler, lines):
+    """
+    Stops the profiler and summarizes the slowest functions
+
+    :params:
+            profiler (cProfile.Profile) profiler from start_profiler
+            lines (int) number of functions to include
+
+    :returns: (string) pstats summary sorted by cumulative time
+    """
+    profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative") \
+        .print_stats(lines)
+    return output.getvalue()
@@ -0,0 +1,65 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Token bucket rate limiter keyed by user id (JWT sub)
+#
+# Each user gets a bucket of rate_limit_burst tokens that refills at
+# rate_limit_per_second. A request takes one token. Buckets are kept per
+# instance in a bounded LRU so idle users are dropped first.
+#
+# Sources: Token bucket
+#          https://en.wikipedia.org/wiki/Token_bucket
+import constants as c
+import math
+import threading
+import time
+from collections import OrderedDict
+
+_lock = threading.Lock()
+_buckets = OrderedDict()
+_stats = {"allowed": 0, "limited": 0}
+
+
+def take(user_id):
+    """
+    Takes a token from a user's bucket
+
+    :params:
+            user_id (string) JWT sub of the user
+
+    :returns: (int) 0 if the request is allowed, otherwise seconds until a
+            token is available for the Retry-After header
+    """
+    now = time.monotonic()
+    with _lock:
+        bucket = _buckets.get(user_id)
+        if bucket is None:
+            bucket = {"tokens": c.rate_limit_burst, "updated": now}
+            _buckets[user_id] = bucket
+            while len(_buckets) > c.rate_limit_users:
+                _buckets.popitem(last=False)
+        _buckets.move_to_end(user_id)
+
+        # Refill for the time since the bucket was last used
+        bucket["tokens"] = min(c.rate_limit_burst, bucket["tokens"] +
+                               (now - bucket["updated"]) *
+                               c.rate_limit_per_second)
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            _stats["allowed"] += 1
+            return 0
+        _stats["limited"] += 1
+        return max(1, math.ceil((1 - bucket["tokens"]) /
+                                c.rate_limit_per_second))
+
+
+def get_rate_limit_stats():
+    """
+    Gets counts of allowed and limited requests
+
+    :returns: (dict) allowed and limited counts and number of buckets
+    """
+    with _lock:
+        return {"allowed": _stats["allowed"],
+                "limited": _stats["limited"],
+                "users": len(_buckets)}
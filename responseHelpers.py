@@ -0,0 +1,200 @@
+# Author: Ren Demeis-Ortiz
+# Course: CS493 Cloud Application Development (Final Project)
+# Description: Response serialization. Boats and loads are turned into plain
+#              records once, encoded with orjson when it is installed and
+#              long lists are streamed in chunks
+#
+# Sources: orjson
+#          https://github.com/ijl/orjson
+from flask import g, request, Response
+import json
+import time
+import constants as c
+import profileHelpers as profile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode(obj):
+    """
+    Encodes an object as compact JSON with orjson if it is installed,
+    otherwise with the json module
+
+    :params:
+            obj object to serialize
+
+    :returns: (bytes) UTF-8 JSON
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False) \
+        .encode()
+
+
+def dumps(obj):
+    """
+    encode that records its time as serialize
+
+    :params:
+            obj object to serialize
+
+    :returns: (bytes) UTF-8 JSON
+    """
+    start = time.perf_counter()
+    try:
+        return encode(obj)
+    finally:
+        profile.record("serialize", (time.perf_counter() - start) * 1000)
+
+
+def get_link_prefix(entity_kind):
+    """
+    Gets the start of the self links for a kind, made once per request
+
+    :params:
+            entity_kind (string) is the type of entity
+
+    :returns: (string) host url and kind ending in a slash
+    """
+    prefixes = g.setdefault("link_prefixes", {})
+    prefix = prefixes.get(entity_kind)
+    if prefix is None:
+        prefix = request.host_url + entity_kind + "/"
+        prefixes[entity_kind] = prefix
+    return prefix
+
+
+def get_self_url(entity_kind, id):
+    """
+    Creates a url to access the resource that has the id passed
+
+    :params:
+            entity_kind (string) is the type of entity
+            id (int) id of entity create link for
+
+    :returns: url (string) url to the entity with the given id
+    """
+    return get_link_prefix(entity_kind) + str(id)
+
+
+def get_properties(entity):
+    """
+    Copies the properties of an entity that are sent to clients
+
+    :params:
+            entity (datastore entity) boat or load entity
+
+    :returns: record (dict) id and visible properties
+    """
+    record = {"id": entity.key.id_or_name}
+    for k, v in entity.items():
+        if k not in c.hidden_properties:
+            record[k] = v
+    return record
+
+
+def select_fields(record, fields):
+    """
+    Keeps only the fields asked for with ?fields=
+
+    :params:
+            record (dict) boat or load record
+            fields (list) fields to keep or None to keep every field
+
+    :returns: record (dict) record with the fields in the order asked for
+    """
+    if fields is None:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+def load_record(load, fields=None):
+    """
+    Makes the record sent for a load with its carrier as an id and self link
+
+    :params:
+            load (datastore entity) load entity
+            fields (list) fields to keep or None to keep every field
+
+    :returns: record (dict) load record
+    """
+    record = get_properties(load)
+    carrier = record.get("carrier")
+    if carrier:
+        record["carrier"] = {"id": carrier,
+                             "self": get_self_url(c.boats, carrier)}
+    record["self"] = get_self_url(c.loads, record["id"])
+    return select_fields(record, fields)
+
+
+def boat_record(boat, fields=None, loads=None):
+    """
+    Makes the record sent for a boat
+
+    :params:
+            boat (datastore entity) boat entity
+            fields (list) fields to keep or None to keep every field
+            loads (list) load records to embed, otherwise loads is a link to
+                        the boat's loads
+
+    :returns: record (dict) boat record
+    """
+    record = get_properties(boat)
+    record["self"] = get_self_url(c.boats, record["id"])
+    if loads is None:
+        record["loads"] = record["self"] + "/" + c.loads
+    else:
+        record["loads"] = loads
+    return select_fields(record, fields)
+
+
+def json_response(obj, status=200, headers=None):
+    """
+    Serializes an object into a JSON response
+
+    :params:
+            obj object to serialize
+            status (int) status code
+            headers (dict) response headers
+
+    :returns: (flask response) JSON response
+    """
+    return Response(dumps(obj), status, headers, mimetype="application/json")
+
+
+def list_response(results, entity_kind, records, status=200, headers=None):
+    """
+    Serializes a list of records with the other properties of results, e.g.
+    next and prev links. Lists longer than stream_min_items are streamed in
+    chunks so the whole body is never built as one string.
+
+    :params:
+            results (dict) properties sent with the list
+            entity_kind (string) property the list is sent as
+            records (list) records to send
+            status (int) status code
+            headers (dict) response headers
+
+    :returns: (flask response) JSON response
+    """
+    page = {k: v for k, v in results.items() if k != entity_kind}
+    if len(records) <= c.stream_min_items:
+        page[entity_kind] = records
+        return json_response(page, status, headers)
+
+    start = dumps(page)[:-1]
+    if page:
+        start += b","
+    start += b'"' + entity_kind.encode() + b'":['
+
+    def generate():
+        yield start
+        for i in range(0, len(records), c.stream_chunk_size):
+            chunk = encode(records[i:i + c.stream_chunk_size])[1:-1]
+            yield (b"," if i else b"") + chunk
+        yield b"]}"
+
+    return Response(generate(), status, headers, mimetype="application/json")
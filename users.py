@@ -6,7 +6,7 @@
 #          https://canvas.oregonstate.edu/courses/1870359/modules/items/22099651
 
 from flask import abort, request, Blueprint
-import json
+import responseHelpers as r
 import constants as c
 import datastoreHelpers as ds
 
@@ -20,7 +20,7 @@ def user_get():
         abort(406)
     if request.method == 'GET':
         results = ds.get_full_collection(c.users, request)
-        return json.dumps(results), 200
+        return r.json_response(results)
 
     else:
         abort(405)